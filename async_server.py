@@ -0,0 +1,240 @@
+# CITS3002 2021 Assignment
+#
+# This file implements an asyncio version of the game server. It plays by the
+# same rules as server.py (see game.py), but each client connection is an
+# asyncio stream and each game runs as its own task, owning its own room and
+# tiles.Board. Games only ever wait on their own players, so any number of them
+# can be in progress at once without a slow game holding up the rest.
+#
+# Logging goes through jsonlog.py, as in server.py; every message received is
+# logged at debug level, which is off by default.
+
+import argparse
+import asyncio
+import logging
+import sys
+from collections import deque
+
+import jsonlog
+import tiles
+from engine import STANDARD_RULES, add_rules_arguments, rules_from_arguments
+from game import GameRoom
+from protocol import MessageDecoder, ProtocolError, encode
+
+
+# a client that lets this many bytes pile up unread is disconnected, rather
+# than letting it hold up its game or grow the server without bound
+MAX_BUFFERED = 1 << 20
+
+log = logging.getLogger('async_server')
+
+
+class StreamConnection:
+  """Per-client state for a connection served by asyncio streams."""
+
+  def __init__(self, reader, writer, idnum):
+    host, port = writer.get_extra_info('peername')[:2]
+    self.reader = reader
+    self.writer = writer
+    self.address = (host, port)
+    self.idnum = idnum
+    self.name = '{}:{}'.format(host, port)
+    self.inbox = None # the queue of the room this client is playing in
+    self.outbuf = bytearray()
+    self.closed = False
+
+  def send(self, msg):
+    """Queue msg for this client. Queued messages are only handed to the
+    transport by flush(), so that a whole turn goes out in one write.
+    """
+    if not self.closed:
+      self.outbuf += encode(msg)
+
+  def flush(self):
+    if self.closed or not self.outbuf:
+      return
+
+    if self.writer.is_closing():
+      self.outbuf.clear()
+      return
+
+    self.writer.write(self.outbuf)
+    self.outbuf = bytearray()
+
+    if self.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+      log.warning('client %s is not reading, disconnecting', self.address,
+        extra={'idnum': self.idnum})
+      self.close()
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.writer.close()
+
+
+class AsyncServer:
+  """Accepts clients into a lobby and runs a task for each game started from
+  it, played by rules (an engine.Rules).
+  """
+
+  def __init__(self, rules=STANDARD_RULES):
+    self.rules = rules
+    self.lobby = deque() # connections waiting for a game, longest first
+    self.games = set()   # running game tasks
+    self.next_idnum = 0
+    self.free_idnums = []
+
+  def allocate_idnum(self):
+    if self.free_idnums:
+      return self.free_idnums.pop()
+    if self.next_idnum >= tiles.IDNUM_LIMIT:
+      return None
+    idnum = self.next_idnum
+    self.next_idnum += 1
+    return idnum
+
+  async def serve_forever(self, host='', port=30020):
+    server = await asyncio.start_server(self.handle_client, host, port,
+      backlog=128)
+
+    for sock in server.sockets:
+      log.info('listening on %s', sock.getsockname())
+
+    async with server:
+      await server.serve_forever()
+
+  async def handle_client(self, reader, writer):
+    idnum = self.allocate_idnum()
+    if idnum == None:
+      writer.close()
+      return
+
+    connection = StreamConnection(reader, writer, idnum)
+    log.info('received connection from %s', connection.address,
+      extra={'idnum': idnum})
+
+    connection.send(tiles.MessageWelcome(idnum))
+    connection.flush()
+    self.lobby.append(connection)
+    self.matchmake()
+
+    decoder = MessageDecoder(compact=True)
+
+    try:
+      while not connection.closed:
+        chunk = await reader.read(4096)
+        if not chunk:
+          break
+
+        debug = log.isEnabledFor(logging.DEBUG)
+        for msg in decoder.feed(chunk):
+          if debug:
+            log.debug('received message %s', msg, extra={'idnum': idnum})
+
+          if connection.inbox != None:
+            connection.inbox.put_nowait((connection, msg))
+    except ProtocolError as e:
+      log.warning('client %s sent a bad message: %s', connection.address, e,
+        extra={'idnum': idnum})
+    except OSError:
+      pass
+    finally:
+      log.info('client %s disconnected', connection.address,
+        extra={'idnum': idnum})
+      connection.close()
+
+      if connection in self.lobby:
+        self.lobby.remove(connection)
+      if connection.inbox != None:
+        connection.inbox.put_nowait((connection, None))
+
+      self.free_idnums.append(idnum)
+
+  def matchmake(self):
+    """Start a game for every group of players the lobby can fill."""
+    while len(self.lobby) >= 2:
+      count = min(len(self.lobby), self.rules.player_limit)
+      players = [self.lobby.popleft() for _ in range(count)]
+
+      task = asyncio.create_task(self.run_game(players))
+      self.games.add(task)
+      task.add_done_callback(self.games.discard)
+
+      log.info('starting game with %d players, %d games running', count,
+        len(self.games), extra={'idnums': [player.idnum for player in players]})
+
+  async def run_game(self, players):
+    """Play a single game to completion, then return its players to the
+    lobby.
+    """
+    inbox = asyncio.Queue()
+    room = GameRoom(players, rules=self.rules)
+
+    for player in players:
+      player.inbox = inbox
+
+    try:
+      room.start()
+      flush_room(room)
+
+      while not room.finished:
+        player, msg = await inbox.get()
+
+        # a message of None means that the player has disconnected
+        if msg is None:
+          room.remove_player(player)
+        else:
+          try:
+            room.handle_message(player, msg)
+          except Exception:
+            # a bug in one game must not take down the server; the player
+            # is removed from the room below
+            log.exception('error handling message %s from client %s', msg,
+              player.address, extra={'idnum': player.idnum})
+            player.close()
+
+        for other in list(room.connected):
+          if other.closed:
+            room.remove_player(other)
+
+        flush_room(room)
+    finally:
+      for player in players:
+        player.inbox = None
+
+    log.info('game finished, %d games running', len(self.games) - 1)
+
+    for player in room.connected:
+      if not player.closed:
+        self.lobby.append(player)
+
+    self.matchmake()
+
+
+def flush_room(room):
+  """Hand everything queued for the room's players to their transports."""
+  for player in room.connected:
+    player.flush()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Tiles game server (asyncio).')
+  parser.add_argument('port', nargs='?', type=int, default=30020)
+  add_rules_arguments(parser)
+  jsonlog.add_logging_arguments(parser)
+  args = parser.parse_args(argv[1:])
+
+  jsonlog.configure_from_arguments(args)
+  rules = rules_from_arguments(args)
+  if not rules.is_standard():
+    log.info('using non-standard %s', rules)
+
+  # listen on all network interfaces
+  try:
+    asyncio.run(AsyncServer(rules).serve_forever('', args.port))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,218 @@
+# CITS3002 2021 Assignment
+#
+# This module stores many boards at once as NumPy arrays, for simulations,
+# bots and replay checking that need to play thousands of games. Token
+# movement is done for every token on every board together, in lock-step,
+# using the same transition table as engine.Board, and gives the same results
+# as tiles.Board.do_player_movement.
+#
+# A board in the batch has one token slot per player, so the players on each
+# board must use the idnums 0..rules.player_limit-1.
+#
+# This module needs numpy, which nothing else in the game depends on.
+
+import numpy as np
+
+import engine
+import tiles
+
+
+EMPTY = -1 # tile id of an empty square, and position of a missing token
+
+# engine.TRANSITIONS, split into one array per field
+TRANSITION_EXIT, TRANSITION_DX, TRANSITION_DY, TRANSITION_NEXT = (
+  np.array(field, dtype=np.intp) for field in zip(*engine.TRANSITIONS))
+
+
+class BoardBatch:
+  """count boards of the same size, indexed 0..count-1.
+
+  Per square (shape (count, width*height), indexed by x + y*width):
+    tileids, tilerotations, tileplaceids, with EMPTY for empty squares.
+  Per token (shape (count, player_limit), indexed by idnum):
+    tokenx, tokeny, tokenposition, with EMPTY for players without a token;
+    tokenorder, the order in which each board's tokens were first placed;
+    live, whether the player is still in the game.
+  """
+
+  def __init__(self, count, rules=engine.STANDARD_RULES):
+    self.count = count
+    self.rules = rules
+    self.width = rules.width
+    self.height = rules.height
+
+    squares = (count, rules.width * rules.height)
+    tokens = (count, rules.player_limit)
+
+    self.tileids = np.full(squares, EMPTY, dtype=np.int16)
+    self.tilerotations = np.zeros(squares, dtype=np.int8)
+    self.tileplaceids = np.full(squares, EMPTY, dtype=np.int32)
+
+    self.tokenx = np.zeros(tokens, dtype=np.int32)
+    self.tokeny = np.zeros(tokens, dtype=np.int32)
+    self.tokenposition = np.full(tokens, EMPTY, dtype=np.int8)
+    self.tokenorder = np.full(tokens, EMPTY, dtype=np.int32)
+    self.tokencount = np.zeros(count, dtype=np.int32)
+    self.live = np.ones(tokens, dtype=bool)
+
+  def set_tiles(self, boards, x, y, tileid, rotation, idnum):
+    """Place a tile on each of the given boards. Every argument is an array
+    (or scalar) with one entry per board. Placements are not checked against
+    the rules.
+    """
+    idx = np.asarray(x) + np.asarray(y) * self.width
+    self.tileids[boards, idx] = tileid
+    self.tilerotations[boards, idx] = rotation
+    self.tileplaceids[boards, idx] = idnum
+
+  def set_token_positions(self, boards, idnum, x, y, position):
+    """Put the tokens of idnum on each of the given boards at x, y, position,
+    as tiles.Board.update_player_position does.
+    """
+    boards = np.asarray(boards)
+    idnum = np.broadcast_to(idnum, boards.shape)
+
+    # a token placed for the first time goes after the others on its board
+    new = self.tokenposition[boards, idnum] == EMPTY
+    if new.any():
+      for board, player in zip(boards[new], idnum[new]):
+        self.tokenorder[board, player] = self.tokencount[board]
+        self.tokencount[board] += 1
+
+    self.tokenx[boards, idnum] = x
+    self.tokeny[boards, idnum] = y
+    self.tokenposition[boards, idnum] = position
+
+  def load(self, index, board, live_idnums):
+    """Copy a tiles.Board (or engine.Board) of the same size, and its live
+    players, into the board at index.
+    """
+    tileids = [EMPTY if t == None else t for t in board.tileids]
+    self.tileids[index] = tileids
+    self.tilerotations[index] = [r or 0 for r in board.tilerotations]
+    self.tileplaceids[index] = [EMPTY if p == None else p
+      for p in board.tileplaceids]
+
+    self.tokenposition[index] = EMPTY
+    self.tokenorder[index] = EMPTY
+    self.tokencount[index] = 0
+    for idnum, (x, y, position) in board.playerpositions.items():
+      self.set_token_positions([index], idnum, x, y, position)
+
+    self.live[index] = False
+    self.live[index, list(live_idnums)] = True
+
+  def to_board(self, index):
+    """The board at index as an engine.Board."""
+    board = engine.Board(self.rules)
+    for idx in np.flatnonzero(self.tileids[index] != EMPTY):
+      board.tileids[idx] = int(self.tileids[index, idx])
+      board.tilerotations[idx] = int(self.tilerotations[index, idx])
+      board.tileplaceids[idx] = int(self.tileplaceids[index, idx])
+
+    for idnum in self.tokens_in_order(index):
+      board.update_player_position(idnum, int(self.tokenx[index, idnum]),
+        int(self.tokeny[index, idnum]), int(self.tokenposition[index, idnum]))
+    return board
+
+  def live_idnums(self, index):
+    return [int(i) for i in np.flatnonzero(self.live[index])]
+
+  def tokens_in_order(self, index):
+    """The idnums with a token on the board at index, in the order they were
+    placed.
+    """
+    order = self.tokenorder[index]
+    placed = np.flatnonzero(order != EMPTY)
+    return [int(i) for i in placed[np.argsort(order[placed])]]
+
+  def do_player_movement(self):
+    """Move every live token that sits on a placed tile, on every board, until
+    it reaches an empty square or leaves the board. Players whose tokens leave
+    the board are no longer live.
+
+    Returns (moved, eliminated), boolean arrays with one entry per token.
+    """
+    width = self.width
+    height = self.height
+    players = self.rules.player_limit
+
+    # flat views, one entry per token
+    tokenx = self.tokenx.reshape(-1)
+    tokeny = self.tokeny.reshape(-1)
+    tokenposition = self.tokenposition.reshape(-1)
+    tileids = self.tileids.reshape(-1)
+    tilerotations = self.tilerotations.reshape(-1)
+    squares = width * height
+
+    moved = np.zeros(self.count * players, dtype=bool)
+    eliminated = np.zeros(self.count * players, dtype=bool)
+
+    active = np.flatnonzero(self.live.reshape(-1) & (tokenposition != EMPTY))
+    x = tokenx[active]
+    y = tokeny[active]
+    position = tokenposition[active].astype(np.intp)
+    base = (active // players) * squares
+
+    # only tokens waiting on a placed tile move
+    square = base + x + y * width
+    onboard = tileids[square] != EMPTY
+    active, x, y, position, base, square = (active[onboard], x[onboard],
+      y[onboard], position[onboard], base[onboard], square[onboard])
+    moved[active] = True
+
+    while active.size:
+      t = ((tileids[square].astype(np.intp) << 5)
+        | ((tilerotations[square] & 3).astype(np.intp) << 3) | position)
+      nx = x + TRANSITION_DX[t]
+      ny = y + TRANSITION_DY[t]
+
+      # tokens that would step off the board stop at the exit, eliminated
+      off = (nx < 0) | (nx >= width) | (ny < 0) | (ny >= height)
+      if off.any():
+        done = active[off]
+        tokenx[done] = x[off]
+        tokeny[done] = y[off]
+        tokenposition[done] = TRANSITION_EXIT[t[off]]
+        eliminated[done] = True
+
+        keep = ~off
+        active, nx, ny, t, base = (active[keep], nx[keep], ny[keep], t[keep],
+          base[keep])
+
+      x = nx
+      y = ny
+      position = TRANSITION_NEXT[t]
+      square = base + x + y * width
+
+      # tokens that reach an empty square wait there
+      stop = tileids[square] == EMPTY
+      if stop.any():
+        done = active[stop]
+        tokenx[done] = x[stop]
+        tokeny[done] = y[stop]
+        tokenposition[done] = position[stop]
+
+        keep = ~stop
+        active, x, y, position, base, square = (active[keep], x[keep],
+          y[keep], position[keep], base[keep], square[keep])
+
+    moved = moved.reshape(self.count, players)
+    eliminated = eliminated.reshape(self.count, players)
+    self.live &= ~eliminated
+    return moved, eliminated
+
+  def movement_result(self, index, moved, eliminated):
+    """The result of do_player_movement for the board at index, in the form
+    returned by tiles.Board.do_player_movement: (positionupdates, eliminated).
+    """
+    positionupdates = []
+    eliminatedids = []
+    for idnum in self.tokens_in_order(index):
+      if moved[index, idnum]:
+        positionupdates.append(tiles.MessageMoveToken(idnum,
+          int(self.tokenx[index, idnum]), int(self.tokeny[index, idnum]),
+          int(self.tokenposition[index, idnum])))
+      if eliminated[index, idnum]:
+        eliminatedids.append(idnum)
+    return positionupdates, eliminatedids
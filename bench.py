@@ -0,0 +1,441 @@
+# CITS3002 2021 Assignment
+#
+# Microbenchmarks for the message handling and game logic hot paths.
+#
+# usage: python bench.py <benchmark> [options]
+# run 'python bench.py -h' for the list of benchmarks.
+
+import argparse
+import copy
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+import engine
+import sim
+import tiles
+from protocol import MessageDecoder, encode, read_message
+
+
+def best_of(repeat, fn, *args):
+  """Run fn(*args) repeat times, and return the fastest time in seconds."""
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    if best == None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def sample_messages(count):
+  """count messages, in the mix seen during a game."""
+  msgs = [
+    tiles.MessagePlaceTile(1, 4, 2, 3, 0),
+    tiles.MessageMoveToken(1, 3, 1, 5),
+    tiles.MessageMoveToken(2, 0, 4, 7),
+    tiles.MessageAddTileToHand(9),
+    tiles.MessagePlayerTurn(2),
+  ]
+  return [msgs[i % len(msgs)] for i in range(count)]
+
+
+def sample_stream(count):
+  """Packed bytes of count messages, in the mix seen during a game."""
+  return b''.join(msg.pack() for msg in sample_messages(count))
+
+
+def decode_by_slicing(data):
+  # the loop used by the original server and client
+  buffer = bytearray(data)
+  count = 0
+  while True:
+    msg, consumed = tiles.read_message_from_bytearray(buffer)
+    if not consumed:
+      break
+    buffer = buffer[consumed:]
+    count += 1
+  return count
+
+
+def decode_with_decoder(data):
+  return len(MessageDecoder().feed(data))
+
+
+def bench_decode(args):
+  """Decode bursts of messages arriving in a single chunk."""
+  print('{:>8} {:>14} {:>14}'.format('burst', 'slicing ns/msg', 'decoder ns/msg'))
+
+  for count in args.sizes:
+    data = sample_stream(count)
+    assert decode_by_slicing(data) == decode_with_decoder(data) == count
+
+    slicing = best_of(args.repeat, decode_by_slicing, data)
+    decoder = best_of(args.repeat, decode_with_decoder, data)
+
+    print('{:>8} {:>14.0f} {:>14.0f}'.format(count,
+      slicing / count * 1e9, decoder / count * 1e9))
+
+
+def decode_each_with_tiles(packed):
+  for bs in packed:
+    tiles.read_message_from_bytearray(bs)
+
+
+def decode_each_with_codec(packed):
+  for bs in packed:
+    read_message(bs)
+
+
+def encode_each_with_pack(msgs):
+  for msg in msgs:
+    msg.pack()
+
+
+def encode_each_with_codec(msgs):
+  for msg in msgs:
+    encode(msg)
+
+
+def bench_codec(args):
+  """Message rate of tiles' decode/pack against the protocol codec."""
+  msgs = sample_messages(args.count)
+  packed = [bytearray(msg.pack()) for msg in msgs]
+
+  for msg, bs in zip(msgs, packed):
+    assert encode(msg) == bs
+    decoded, consumed = read_message(bs)
+    assert consumed == len(bs) and vars(decoded) == vars(msg)
+
+  print('{:>8} {:>12} {:>12} {:>8}'.format('', 'tiles msg/s', 'codec msg/s',
+    'speedup'))
+
+  for name, old, new, data in [
+      ('decode', decode_each_with_tiles, decode_each_with_codec, packed),
+      ('encode', encode_each_with_pack, encode_each_with_codec, msgs)]:
+    oldrate = args.count / best_of(args.repeat, old, data)
+    newrate = args.count / best_of(args.repeat, new, data)
+    print('{:>8} {:>12.0f} {:>12.0f} {:>7.2f}x'.format(name, oldrate, newrate,
+      newrate / oldrate))
+
+
+def decode_all(data, compact):
+  return MessageDecoder(compact=compact).feed(data)
+
+
+def bench_messages(args):
+  """Memory, GC activity and time to decode and hold a burst of messages, as
+  tiles classes and as compact messages.
+  """
+  data = sample_stream(args.count)
+
+  print('{:>8} {:>10} {:>12} {:>10}'.format('', 'bytes/msg', 'gen0 GCs',
+    'ns/msg'))
+
+  for name, compact in [('tiles', False), ('compact', True)]:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    msgs = decode_all(data, compact)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del msgs
+
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    decode_all(data, compact)
+    collections = gc.get_stats()[0]['collections'] - collections
+
+    elapsed = best_of(args.repeat, decode_all, data, compact)
+
+    print('{:>8} {:>10.1f} {:>12} {:>10.0f}'.format(name, held / args.count,
+      collections, elapsed / args.count * 1e9))
+
+
+def random_boards(count, seed=0, rules=engine.STANDARD_RULES):
+  """count board states taken from random games, each just after a tile has
+  been placed and before the tokens are moved, as (tileids, tilerotations,
+  playerpositions, live_idnums, square the tile was placed on).
+  """
+  rng = random.Random(seed)
+  states = []
+
+  while len(states) < count:
+    board = engine.Board(rules)
+    live_idnums = list(range(rules.player_limit))
+
+    # everyone places a tile on the edge, and starts their token on it
+    for idnum in range(rules.player_limit):
+      x, y = rng.choice([(x, y) for x in range(board.width)
+        for y in range(board.height)
+        if board.start_positions(x, y) and board.get_tile(x, y)[0] == None])
+      board.set_tile(x, y, rng.randrange(len(tiles.ALL_TILES)),
+        rng.randrange(4), idnum)
+      board.set_player_start_position(idnum, x, y,
+        rng.choice(board.start_positions(x, y)))
+
+      _, eliminated = board.do_player_movement(live_idnums)
+      live_idnums = [i for i in live_idnums if i not in eliminated]
+
+    while live_idnums and len(states) < count:
+      idnum = rng.choice(live_idnums)
+      x, y, _ = board.get_player_position(idnum)
+      board.set_tile(x, y, rng.randrange(len(tiles.ALL_TILES)),
+        rng.randrange(4), idnum)
+
+      states.append((list(board.tileids), list(board.tilerotations),
+        dict(board.playerpositions), list(live_idnums), (x, y)))
+
+      _, eliminated = board.do_player_movement(live_idnums)
+      live_idnums = [i for i in live_idnums if i not in eliminated]
+
+  return states
+
+
+def load_boards(make_board, states):
+  boards = []
+  for tileids, tilerotations, playerpositions, live_idnums, placed in states:
+    board = make_board()
+    board.tileids[:] = tileids
+    board.tilerotations[:] = tilerotations
+    for idnum, (x, y, position) in playerpositions.items():
+      board.update_player_position(idnum, x, y, position)
+    boards.append((board, live_idnums, placed))
+  return boards
+
+
+def move_all(boards):
+  return [board.do_player_movement(live_idnums)
+    for board, live_idnums, placed in boards]
+
+
+def move_all_at(boards):
+  return [board.do_player_movement_at(x, y, live_idnums)
+    for board, live_idnums, (x, y) in boards]
+
+
+def time_movement(make_board, move, states, repeat):
+  """The fastest time to move the tokens on every state with move, not
+  counting the time taken to set up the boards.
+  """
+  best = None
+  for _ in range(repeat):
+    boards = load_boards(make_board, states)
+    elapsed = best_of(1, move, boards)
+    if best == None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def movement_results(results):
+  """Comparable form of a list of do_player_movement results."""
+  return [([vars(msg) for msg in positionupdates], eliminated)
+    for positionupdates, eliminated in results]
+
+
+def bench_movement(args):
+  """Token movement of tiles.Board against engine.Board."""
+  rules = engine.rules_from_arguments(args)
+  states = random_boards(args.count, rules=rules)
+  make_board = lambda: engine.Board(rules)
+
+  runs = [
+    ('engine', make_board, move_all),
+    ('engine at', make_board, move_all_at),
+  ]
+
+  # tiles.Board only supports the standard board
+  if rules.is_standard():
+    runs.insert(0, ('tiles', tiles.Board, move_all))
+
+  expected = movement_results(move_all(load_boards(runs[0][1], states)))
+
+  print('{:>12} {:>14} {:>8}'.format('', 'boards/s', 'speedup'))
+
+  basetime = None
+  for name, make_board, move in runs:
+    assert movement_results(move(load_boards(make_board, states))) == expected
+
+    elapsed = time_movement(make_board, move, states, args.repeat)
+    if basetime == None:
+      basetime = elapsed
+
+    print('{:>12} {:>14.0f} {:>7.2f}x'.format(name, args.count / elapsed,
+      basetime / elapsed))
+
+
+def load_batch(states, rules):
+  import batch
+  boards = batch.BoardBatch(len(states), rules)
+  for index, (tileids, tilerotations, playerpositions, live_idnums,
+      placed) in enumerate(states):
+    board = engine.Board(rules)
+    board.tileids[:] = tileids
+    board.tilerotations[:] = tilerotations
+    for idnum, (x, y, position) in playerpositions.items():
+      board.update_player_position(idnum, x, y, position)
+    boards.load(index, board, live_idnums)
+  return boards
+
+
+def bench_batch(args):
+  """Token movement of engine.Board against batch.BoardBatch (needs numpy)."""
+  rules = engine.rules_from_arguments(args)
+  states = random_boards(args.count, rules=rules)
+
+  expected = movement_results(move_all(load_boards(
+    lambda: engine.Board(rules), states)))
+  boards = load_batch(states, rules)
+  moved, eliminated = boards.do_player_movement()
+  assert movement_results(boards.movement_result(index, moved, eliminated)
+    for index in range(len(states))) == expected
+
+  print('{:>12} {:>14} {:>8}'.format('', 'boards/s', 'speedup'))
+
+  basetime = time_movement(lambda: engine.Board(rules), move_all, states,
+    args.repeat)
+  print('{:>12} {:>14.0f} {:>7.2f}x'.format('engine', args.count / basetime,
+    1.0))
+
+  best = None
+  for _ in range(args.repeat):
+    boards = load_batch(states, rules)
+    elapsed = best_of(1, boards.do_player_movement)
+    if best == None or elapsed < best:
+      best = elapsed
+  print('{:>12} {:>14.0f} {:>7.2f}x'.format('batch', args.count / best,
+    basetime / best))
+
+
+def turn_states(count, seed=0):
+  """count (board, idnum, hand, live_idnums) from the start of turns in
+  random games, where the player already has a token on the board.
+  """
+  states = []
+
+  def record(room, idnum, rng):
+    if room.board.have_player_position(idnum) and len(states) < count:
+      states.append((copy.deepcopy(room.board), idnum,
+        list(room.hands[idnum]), list(room.live_idnums)))
+    return sim.random_policy(room, idnum, rng)
+
+  while len(states) < count:
+    sim.play_game([record] * tiles.PLAYER_LIMIT, seed)
+    seed += 1
+  return states
+
+
+def moves_by_copying(states):
+  # try every tile and rotation on a copy of the board
+  results = []
+  for board, idnum, hand, live_idnums in states:
+    x, y, _ = board.get_player_position(idnum)
+    for tileid in hand:
+      for rotation in range(4):
+        trial = copy.deepcopy(board)
+        trial.set_tile(x, y, tileid, rotation, idnum)
+        _, eliminated = trial.do_player_movement(live_idnums)
+        results.append((tileid, rotation, trial.get_player_position(idnum),
+          idnum in eliminated))
+  return results
+
+
+def moves_with_journal(states):
+  # try every tile and rotation on the board itself, undoing each after
+  results = []
+  for board, idnum, hand, live_idnums in states:
+    x, y, _ = board.get_player_position(idnum)
+    for tileid in hand:
+      for rotation in range(4):
+        board.push()
+        board.set_tile(x, y, tileid, rotation, idnum)
+        _, eliminated = board.do_player_movement_at(x, y, live_idnums)
+        results.append((tileid, rotation, board.get_player_position(idnum),
+          idnum in eliminated))
+        board.pop()
+  return results
+
+
+def moves_with_generator(states):
+  return [board.legal_moves(idnum, hand, live_idnums)
+    for board, idnum, hand, live_idnums in states]
+
+
+def bench_moves(args):
+  """Outcomes of every move for a hand, by copying the board for each one,
+  by undoing each with the board's journal, and with engine.Board.legal_moves.
+  """
+  states = turn_states(args.count)
+  assert moves_with_journal(states) == moves_by_copying(states)
+
+  # every outcome found by copying is the same as the generator's outcome
+  # for that tile and its equivalent rotation
+  outcomes = {}
+  for (board, idnum, hand, live_idnums), moves in zip(states,
+      moves_with_generator(states)):
+    for move in moves:
+      outcomes[id(board), move.tileid, move.rotation] = (
+        move.outcome.position, move.outcome.eliminated)
+  copied = iter(moves_by_copying(states))
+  for board, idnum, hand, live_idnums in states:
+    for tileid in hand:
+      for rotation in range(4):
+        _, _, position, eliminated = next(copied)
+        distinct = engine.DISTINCT_ROTATIONS[tileid]
+        equivalent = distinct[rotation % len(distinct)]
+        assert outcomes[id(board), tileid, equivalent] == (position, eliminated)
+
+  print('{:>12} {:>14} {:>8}'.format('', 'hands/s', 'speedup'))
+
+  basetime = None
+  for name, run in [('copying', moves_by_copying),
+      ('journal', moves_with_journal), ('generator', moves_with_generator)]:
+    elapsed = best_of(args.repeat, run, states)
+    if basetime == None:
+      basetime = elapsed
+    print('{:>12} {:>14.0f} {:>7.2f}x'.format(name, args.count / elapsed,
+      basetime / elapsed))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Tiles microbenchmarks.')
+  parser.add_argument('--repeat', type=int, default=5,
+    help='runs of each measurement, the fastest is reported')
+  benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+  decode = benchmarks.add_parser('decode', help=bench_decode.__doc__)
+  decode.add_argument('sizes', nargs='*', type=int,
+    default=[1000, 4000, 16000, 64000])
+  decode.set_defaults(run=bench_decode)
+
+  codec = benchmarks.add_parser('codec', help=bench_codec.__doc__)
+  codec.add_argument('--count', type=int, default=200000)
+  codec.set_defaults(run=bench_codec)
+
+  msgs = benchmarks.add_parser('messages', help=bench_messages.__doc__)
+  msgs.add_argument('--count', type=int, default=200000)
+  msgs.set_defaults(run=bench_messages)
+
+  movement = benchmarks.add_parser('movement', help=bench_movement.__doc__)
+  movement.add_argument('--count', type=int, default=20000)
+  engine.add_rules_arguments(movement)
+  movement.set_defaults(run=bench_movement)
+
+  moves = benchmarks.add_parser('moves', help=bench_moves.__doc__)
+  moves.add_argument('--count', type=int, default=2000)
+  moves.set_defaults(run=bench_moves)
+
+  batched = benchmarks.add_parser('batch', help=bench_batch.__doc__)
+  batched.add_argument('--count', type=int, default=20000)
+  engine.add_rules_arguments(batched)
+  batched.set_defaults(run=bench_batch)
+
+  args = parser.parse_args(argv[1:])
+  args.run(args)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
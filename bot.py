@@ -0,0 +1,308 @@
+# CITS3002 2021 Assignment
+#
+# This file implements a headless bot player. It connects to the server and
+# speaks the same protocol as client.py, but chooses its own moves, so it can
+# fill games when there are not enough human players.
+#
+# Moves are chosen by a depth-limited expectimax search over the bot's own
+# future turns: at each turn it chooses the best tile and rotation in its
+# hand, and after each placement the tile it draws is a chance event, with
+# every tile equally likely (as the server draws them). The other players'
+# moves are not modelled. Moves are tried on the bot's own board and undone
+# again with its journal. The search deepens one turn at a time until the
+# per-turn time budget runs out, and remembers the values of positions it has
+# already searched in a transposition table with LRU eviction.
+#
+# usage: python bot.py [host] [port] [--budget SECONDS] [--games N]
+
+import argparse
+import random
+import socket
+import sys
+import time
+from collections import OrderedDict
+
+import tiles
+from engine import DISTINCT_ROTATIONS, HashedBoard, Placement
+from protocol import (ADD_TILE_TO_HAND, GAME_START, MOVE_TOKEN, PLACE_TILE,
+  PLAYER_ELIMINATED, PLAYER_JOINED, PLAYER_LEFT, PLAYER_TURN, WELCOME,
+  MessageDecoder, encode, message_type)
+
+
+class SearchTimeout(Exception):
+  """Raised inside the search when the time budget has run out."""
+
+
+class TranspositionTable:
+  """A mapping of searched positions to their values, holding at most
+  capacity entries and evicting the least recently used.
+  """
+
+  def __init__(self, capacity=1 << 18):
+    self.capacity = capacity
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    value = self.entries.get(key)
+    if value == None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return value
+
+  def put(self, key, value):
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    if len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+
+  def __len__(self):
+    return len(self.entries)
+
+
+class Searcher:
+  """Expectimax search of the bot's own turns on a board. Each move tried is
+  made on the board itself between push() and pop(), so the board is never
+  copied, and positions are identified by the board's Zobrist hash.
+
+  The value of a position is the probability of the bot's token surviving
+  the turns searched, if it plays the best move at each of them.
+  """
+
+  def __init__(self, board, idnum, table):
+    self.board = board
+    self.idnum = idnum
+    self.live_idnums = (idnum,) # only the bot's token is moved
+    self.table = table
+    self.deadline = None
+    self.tilecount = len(tiles.ALL_TILES)
+
+  def choose(self, moves, hand, budget):
+    """Choose from moves (Placements or StartPositions from legal_moves), with
+    the rest of the hand after each being hand less the tile placed. Deepens
+    the search until budget seconds have passed, and returns the best move
+    found at the deepest search that finished.
+    """
+    self.deadline = time.perf_counter() + budget
+    best = self.rank(moves, hand, 0)
+
+    # there can be no more turns than empty squares
+    try:
+      for depth in range(1, self.board.tileids.count(None) + 1):
+        best = self.rank(moves, hand, depth)
+    except SearchTimeout:
+      pass
+    return best
+
+  def rank(self, moves, hand, depth):
+    """The best of moves, searching depth turns after it. Ties are broken by
+    the most other players eliminated.
+    """
+    bestscore = None
+    best = []
+    for move in moves:
+      outcome = move.outcome
+      if outcome.eliminated:
+        value = 0.0
+      elif outcome.position == None:
+        value = 1.0
+      else:
+        rest = list(hand)
+        if isinstance(move, Placement):
+          rest.remove(move.tileid)
+        value = self.after_move(move, rest, depth)
+
+      score = (value, len(outcome.eliminates))
+      if bestscore == None or score > bestscore:
+        bestscore = score
+        best = [move]
+      elif score == bestscore:
+        best.append(move)
+    return random.choice(best)
+
+  def after_move(self, move, rest, depth):
+    """The value of making move, with rest left in hand."""
+    board = self.board
+    board.push()
+    try:
+      if isinstance(move, Placement):
+        board.set_tile(move.x, move.y, move.tileid, move.rotation, self.idnum)
+      else:
+        board.set_player_start_position(self.idnum, move.x, move.y,
+          move.position)
+      board.do_player_movement_at(move.x, move.y, self.live_idnums)
+      return self.draw(rest, depth)
+    finally:
+      board.pop()
+
+  def draw(self, rest, depth):
+    """Chance node: the value of the position after drawing a tile to add to
+    rest (a list of tileids).
+    """
+    if depth == 0:
+      return 1.0
+
+    total = 0.0
+    for tileid in range(self.tilecount):
+      total += self.turn(tuple(sorted(rest + [tileid])), depth)
+    return total / self.tilecount
+
+  def turn(self, hand, depth):
+    """Max node: the value of the bot's best placement, holding hand."""
+    board = self.board
+    key = (board.zobrist, hand, depth)
+    value = self.table.get(key)
+    if value != None:
+      return value
+
+    if time.perf_counter() > self.deadline:
+      raise SearchTimeout()
+
+    x, y, _ = board.get_player_position(self.idnum)
+
+    best = 0.0
+    for tileid in set(hand):
+      rest = list(hand)
+      rest.remove(tileid)
+      for rotation in DISTINCT_ROTATIONS[tileid]:
+        board.push()
+        try:
+          board.set_tile(x, y, tileid, rotation, self.idnum)
+          _, eliminated = board.do_player_movement_at(x, y, self.live_idnums)
+          if not eliminated:
+            value = self.draw(rest, depth - 1)
+            if value > best:
+              best = value
+        finally:
+          board.pop()
+        if best == 1.0:
+          break
+      if best == 1.0:
+        break
+
+    self.table.put(key, best)
+    return best
+
+
+class Bot:
+  """The state of the game as seen by one player, and the choice of its
+  moves.
+  """
+
+  def __init__(self, budget=0.5, tablesize=1 << 18):
+    self.budget = budget
+    self.table = TranspositionTable(tablesize)
+    self.idnum = None
+    self.board = HashedBoard()
+    self.hand = []
+    self.joined = []
+    self.live_idnums = []
+    self.games = 0
+
+  def handle_message(self, msg):
+    """Update the game state from msg, and return the message to send in
+    reply, if any.
+    """
+    kind = message_type(msg)
+
+    if kind == WELCOME:
+      self.idnum = msg.idnum
+
+    elif kind == PLAYER_JOINED:
+      self.joined.append(msg.idnum)
+
+    elif kind == GAME_START:
+      self.board.reset()
+      self.hand = []
+      self.live_idnums = self.joined
+      self.joined = []
+      self.games += 1
+
+    elif kind == ADD_TILE_TO_HAND:
+      self.hand.append(msg.tileid)
+
+    elif kind == PLACE_TILE:
+      self.board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum)
+      if msg.idnum == self.idnum:
+        self.hand.remove(msg.tileid)
+
+    elif kind == MOVE_TOKEN:
+      self.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+
+    elif kind in (PLAYER_ELIMINATED, PLAYER_LEFT):
+      if msg.idnum in self.live_idnums:
+        self.live_idnums.remove(msg.idnum)
+
+    elif kind == PLAYER_TURN:
+      if msg.idnum == self.idnum:
+        return self.choose_move()
+
+    return None
+
+  def choose_move(self):
+    moves = self.board.legal_moves(self.idnum, self.hand, self.live_idnums)
+    if not moves:
+      return None
+
+    # first tiles don't move the bot's token, so can be placed anywhere
+    if all(move.outcome.position == None for move in moves):
+      return random.choice(moves).message(self.idnum)
+
+    searcher = Searcher(self.board, self.idnum, self.table)
+    move = searcher.choose(moves, self.hand, self.budget)
+    return move.message(self.idnum)
+
+
+def play(sock, bot, games=None):
+  """Play on a connected socket until the server closes it, or games games
+  have been played.
+  """
+  decoder = MessageDecoder(compact=True)
+  while True:
+    chunk = sock.recv(4096)
+    if not chunk:
+      print('server closed connection')
+      return
+
+    for msg in decoder.feed(chunk):
+      if message_type(msg) == GAME_START and games != None \
+          and bot.games >= games:
+        return
+
+      reply = bot.handle_message(msg)
+      if reply != None:
+        sock.sendall(encode(reply))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Headless bot player.')
+  parser.add_argument('host', nargs='?', default='localhost')
+  parser.add_argument('port', nargs='?', type=int, default=30020)
+  parser.add_argument('--budget', type=float, default=0.5,
+    help='seconds to spend choosing each move (default: %(default)s)')
+  parser.add_argument('--table-size', type=int, default=1 << 18,
+    help='positions kept in the transposition table (default: %(default)s)')
+  parser.add_argument('--games', type=int, default=None,
+    help='games to play before disconnecting (default: no limit)')
+  args = parser.parse_args(argv[1:])
+
+  bot = Bot(args.budget, args.table_size)
+
+  sock = socket.create_connection((args.host, args.port))
+  print('connected to {}:{}'.format(args.host, args.port))
+  try:
+    play(sock, bot, args.games)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sock.close()
+
+  print('played {} games, transposition table {} entries, {} hits, {} misses'
+    .format(bot.games, len(bot.table), bot.table.hits, bot.table.misses))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -11,12 +11,21 @@
 
 from tkinter import *
 from tkinter.ttk import *
+import jsonlog
 import tiles
+from protocol import MessageDecoder
+import logging
+import queue
 import random
 import socket
 import sys
 import threading
 import select
+import time
+
+# every message from the server is logged at debug level, which is off unless
+# TILES_LOG_LEVEL=debug is set (see jsonlog.py)
+log = logging.getLogger('client')
 
 class Application(Frame):
   TILE_PX = 80 # pixels
@@ -34,6 +43,9 @@ class Application(Frame):
   CANVAS_WIDTH_PX = max(BOARD_WIDTH_PX, HAND_WIDTH_PX) + 2 * BORDER_PX
   CANVAS_HEIGHT_PX = BOARD_HEIGHT_PX + TILE_PX + 3 * BORDER_PX
 
+  POLL_MS = 16 # how often received messages are applied, about once a frame
+  FRAME_MS = 16 # least time between redraws, capping them at about 60 per second
+
   def __init__(self, parent=None):
     super().__init__(parent)
     self.parent = parent
@@ -41,18 +53,22 @@ class Application(Frame):
 
     self.sock = None
 
-    self.infolock = threading.Lock()
+    # the network thread only decodes messages and puts them here; all of the
+    # state below is only ever used by the Tk thread, so needs no locks
+    self.inbox = queue.SimpleQueue()
+    self.dirty = set() # parts of the window to redraw: see redraw()
+    self.redrawpending = False # whether a redraw has been scheduled
+    self.lastframe = 0.0 # time.monotonic() of the last redraw
+
     self.idnum = None
     self.playernames = {} # idnum -> player name
 
-    self.handlock = threading.Lock()
     self.hand_offset = tiles.Point(
       (Application.CANVAS_WIDTH_PX - Application.HAND_WIDTH_PX) / 2,
       2 * Application.BORDER_PX + Application.BOARD_HEIGHT_PX)
     self.hand = [None] * Application.HAND_SIZE
     self.handrotations = [0] * Application.HAND_SIZE
 
-    self.boardlock = threading.Lock()
     self.board = tiles.Board()
     self.board.tile_size_px = Application.TILE_PX
     self.lasttilelocation = None
@@ -68,14 +84,18 @@ class Application(Frame):
     self.selected_hand = 0
     self.handrects = [None] * Application.HAND_SIZE
 
-    self.bind('<<ClearBoard>>', lambda ev: self.clear_board())
-    self.bind('<<RedrawBoard>>', lambda ev: self.draw_board())
-    self.bind('<<RedrawHand>>', lambda ev: self.draw_hand())
-    self.bind('<<RedrawTokens>>', lambda ev: self.draw_tokens())
-    self.bind('<<RedrawTurn>>', lambda ev: self.draw_turn())
-    self.bind('<<CloseConnection>>', lambda ev: on_quit())
+    # what is drawn on the canvas, so that each redraw only changes the items
+    # for what has changed since
+    self.dirtysquares = set() # indices of board squares to redraw
+    self.dirtytokens = set()  # idnums of tokens to redraw
+    self.drawnsquares = set() # indices of board squares with a tile drawn
+    self.tokenitems = {}      # idnum -> canvas item of their token
+    self.drawnselection = None # square the selection tokens are drawn on
+    self.drawnhand = [None] * Application.HAND_SIZE # (tileid, rotation)
 
     self.create_widgets()
+
+    self.after(Application.POLL_MS, self.poll_messages)
   
   def create_widgets(self):
     frame = Frame(self, width=Application.CANVAS_WIDTH_PX + 200, height=Application.CANVAS_HEIGHT_PX)
@@ -108,8 +128,6 @@ class Application(Frame):
       self.canvas.tag_bind(cid, "<Button-1>", lambda ev, i=i: self.rotate_hand_tile(ev, i))
     
     self.set_selected_hand(0)
-    
-    self.board.draw_tiles(self.canvas, self.boardoffset)
 
     self.canvas.grid(column=0, row=0, columnspan=1, rowspan=2)
 
@@ -129,32 +147,80 @@ class Application(Frame):
     if self.lasttilelocation != None and self.location == None:
       return
     
-    print('play tile at {}, {}'.format(x, y))
+    log.info('play tile at %d, %d', x, y)
 
     if self.sock:
-      with self.infolock:
-        idnum = self.idnum
-        if idnum != None:
-          with self.handlock:
-            tileid = self.hand[self.selected_hand]
-            rotation = self.handrotations[self.selected_hand]
-            if tileid != None:
-              self.sock.send(tiles.MessagePlaceTile(idnum, tileid, rotation, x, y).pack())
+      idnum = self.idnum
+      if idnum != None:
+        tileid = self.hand[self.selected_hand]
+        rotation = self.handrotations[self.selected_hand]
+        if tileid != None:
+          self.sock.send(tiles.MessagePlaceTile(idnum, tileid, rotation, x, y).pack())
 
   def rotate_hand_tile(self, ev, hand_index):
     if hand_index == self.selected_hand:
-      with self.handlock:
-        self.handrotations[hand_index] = (self.handrotations[hand_index] + 1) % 4
-      self.draw_hand()
+      self.handrotations[hand_index] = (self.handrotations[hand_index] + 1) % 4
+      self.request_redraw('hand')
     else:
       self.set_selected_hand(hand_index)
   
   def choose_starting_token(self, position):
-    with self.boardlock:
-      if self.lasttilelocation and not self.location:
-        x, y = self.lasttilelocation
-        print('start at {},{}:{}'.format(x, y, position))
-        self.sock.send(tiles.MessageMoveToken(self.idnum, x, y, position).pack())
+    if self.lasttilelocation and not self.location:
+      x, y = self.lasttilelocation
+      log.info('start at %d,%d:%d', x, y, position)
+      self.sock.send(tiles.MessageMoveToken(self.idnum, x, y, position).pack())
+
+  def poll_messages(self):
+    """Apply every message received since the last poll. The parts of the
+    window they change are redrawn by the next frame, not here.
+    """
+    while True:
+      try:
+        msg = self.inbox.get_nowait()
+      except queue.Empty:
+        break
+
+      # the network thread has finished
+      if msg == None:
+        if not exited:
+          on_quit()
+        return
+
+      handle_message(msg)
+
+    self.after(Application.POLL_MS, self.poll_messages)
+
+  def request_redraw(self, *parts):
+    """Mark parts of the window ('board', 'hand', 'tokens' or 'turn') to be
+    redrawn. Requests are merged until the next frame, which is scheduled no
+    sooner than FRAME_MS after the last, so a burst of changes costs one
+    redraw of each part.
+    """
+    self.dirty.update(parts)
+    if self.redrawpending or not self.dirty:
+      return
+
+    self.redrawpending = True
+    elapsed = (time.monotonic() - self.lastframe) * 1000
+    delay = max(0, int(Application.FRAME_MS - elapsed))
+    self.after(delay, self.redraw)
+
+  def redraw(self):
+    """Draw each part of the window in self.dirty, then mark it clean. Only
+    called for frames scheduled by request_redraw().
+    """
+    self.redrawpending = False
+    self.lastframe = time.monotonic()
+
+    if 'board' in self.dirty:
+      self.draw_board()
+    if 'hand' in self.dirty:
+      self.draw_hand()
+    if 'tokens' in self.dirty:
+      self.draw_tokens()
+    if 'turn' in self.dirty:
+      self.draw_turn()
+    self.dirty.clear()
   
   def clear_board(self):
     self.canvas.configure(bg='white')
@@ -162,31 +228,106 @@ class Application(Frame):
     self.canvas.delete('board_tile')
     self.canvas.delete('selection_token')
     self.canvas.delete('token')
+
+    self.dirtysquares.clear()
+    self.dirtytokens.clear()
+    self.drawnsquares.clear()
+    self.tokenitems.clear()
+    self.drawnselection = None
   
   def draw_board(self):
-    self.board.draw_tiles(self.canvas, self.boardoffset)
+    """Draw the tiles on the squares in self.dirtysquares. Like
+    tiles.Board.draw_tiles, but leaves the other squares alone.
+    """
+    board = self.board
+
+    for idx in self.dirtysquares:
+      x = idx % board.width
+      y = idx // board.width
+      tag = 'board_tile_{}_{}'.format(x, y)
+
+      if idx in self.drawnsquares:
+        self.canvas.delete(tag)
+        self.drawnsquares.discard(idx)
+
+      tileid = board.tileids[idx]
+      if tileid != None:
+        drawpoint = tiles.Point(self.boardoffset.x + x * board.tile_size_px,
+          self.boardoffset.y + y * board.tile_size_px)
+        tiles.ALL_TILES[tileid].draw(self.canvas, board.tile_size_px, drawpoint,
+          board.tilerotations[idx], tags=('board_tile', tag))
+        self.drawnsquares.add(idx)
+
+        trect = board.tilerects[idx]
+        if trect:
+          self.canvas.itemconfigure(trect, fill="#bbb", activefill="#bbb")
+
+    # keep the tokens above the new tiles
+    if self.dirtysquares:
+      self.canvas.lift('selection_token')
+      self.canvas.lift('token')
+    self.dirtysquares.clear()
   
   def draw_hand(self):
+    """Redraw the hand slots whose tile or rotation has changed."""
     hand_offset = self.hand_offset
 
-    self.canvas.delete('handtile')
+    for i in range(len(self.hand)):
+      drawn = None
+      if self.hand[i] != None:
+        drawn = (self.hand[i], self.handrotations[i])
+      if drawn == self.drawnhand[i]:
+        continue
+
+      tag = 'handtile_{}'.format(i)
+      self.canvas.delete(tag)
+
+      if drawn != None:
+        drawpoint = tiles.Point(hand_offset.x + (Application.TILE_PX + 10) * i, hand_offset.y)
+        tile = tiles.ALL_TILES[self.hand[i]]
+        tile.draw(self.canvas, Application.TILE_PX, drawpoint, self.handrotations[i], ('handtile', tag))
 
-    with self.handlock:
-      for i in range(len(self.hand)):
-        if self.hand[i] != None:
-          drawpoint = tiles.Point(hand_offset.x + (Application.TILE_PX + 10) * i, hand_offset.y)
-          tile = tiles.ALL_TILES[self.hand[i]]
-          tile.draw(self.canvas, Application.TILE_PX, drawpoint, self.handrotations[i], ('handtile'))
+      self.drawnhand[i] = drawn
   
   def draw_tokens(self):
-    with self.boardlock:
-      if self.lasttilelocation and not self.location:
-        x, y = self.lasttilelocation
+    """Show or hide the selection tokens if they have changed, and move or
+    recolour the tokens of the players in self.dirtytokens. Like
+    tiles.Board.draw_tokens, but keeps one canvas item per token.
+    """
+    selection = None
+    if self.lasttilelocation and not self.location:
+      selection = self.lasttilelocation
+
+    if selection != self.drawnselection:
+      self.canvas.delete('selection_token')
+      if selection:
+        x, y = selection
         self.board.draw_selection_tokens(self.canvas, self.boardoffset, self.playernums, x, y, self.choose_starting_token)
+        self.canvas.lift('token')
+      self.drawnselection = selection
+
+    board = self.board
+    for idnum in self.dirtytokens:
+      if idnum not in board.playerpositions:
+        continue
+      x, y, position = board.playerpositions[idnum]
+
+      playercol = tiles.PLAYER_COLOURS[self.playernums[idnum]]
+      if idnum in self.eliminatedlist:
+        playercol = '#ddd'
+
+      delta = tiles.CONNECTION_LOCATIONS[position]
+      cx = self.boardoffset.x + x * board.tile_size_px + int(delta.x * board.tile_size_px)
+      cy = self.boardoffset.y + y * board.tile_size_px + int(delta.y * board.tile_size_px)
+
+      item = self.tokenitems.get(idnum)
+      if item == None:
+        self.tokenitems[idnum] = self.canvas.create_oval(cx - 10, cy - 10, cx + 10, cy + 10,
+          fill=playercol, outline='black', tags=('token'))
       else:
-        self.canvas.delete('selection_token')
-      
-      self.board.draw_tokens(self.canvas, self.boardoffset, self.playernums, self.eliminatedlist)
+        self.canvas.coords(item, cx - 10, cy - 10, cx + 10, cy + 10)
+        self.canvas.itemconfigure(item, fill=playercol)
+    self.dirtytokens.clear()
   
   def draw_turn(self):
     self.canvas.itemconfigure(self.you_won_text, state='hidden')
@@ -206,6 +347,8 @@ class Application(Frame):
       self.canvas.configure(bg=playercolour)
       
 
+jsonlog.configure()
+
 Tcl().eval('set tcl_platform(threaded)')
 
 exited = False
@@ -223,200 +366,174 @@ app = Application(parent=root)
 app.parent.title("Client")
 
 def reset_game_state():
-  print('resetting game state')
+  log.debug('resetting game state')
 
-  with app.handlock:
-    for i in range(len(app.hand)):
-      app.hand[i] = None
-      app.handrotations[i] = 0
-  
-  app.event_generate("<<RedrawHand>>")
-
-  with app.boardlock:
-    app.board.reset()
-    app.lasttilelocation = None
-    app.location = None
-    app.playernums = {}
-    app.playerlist.clear()
-    app.eliminatedlist.clear()
-    app.currentplayerid = None
-  
-  app.event_generate("<<ClearBoard>>")
-  app.event_generate("<<RedrawBoard>>")
-  app.event_generate("<<RedrawTurn>>")
+  for i in range(len(app.hand)):
+    app.hand[i] = None
+    app.handrotations[i] = 0
+
+  app.board.reset()
+  app.lasttilelocation = None
+  app.location = None
+  app.playernums = {}
+  app.playerlist.clear()
+  app.eliminatedlist.clear()
+  app.currentplayerid = None
+
+  app.clear_board()
+  app.request_redraw('hand', 'board', 'turn')
 
 def set_player_turn(idnum):
-  with app.boardlock:
-    if not idnum in app.playernums:
-      playernum = len(app.playernums)
-      app.playernums[idnum] = playernum
-
-      with app.infolock:
-        playername = app.playernames[idnum]
-        app.playerlist.append(playername)
-      
-      app.playerlistvar.set(app.playerlist)
+  if not idnum in app.playernums:
+    playernum = len(app.playernums)
+    app.playernums[idnum] = playernum
+
+    playername = app.playernames[idnum]
+    app.playerlist.append(playername)
     
-    app.currentplayerid = idnum
+    app.playerlistvar.set(app.playerlist)
+  
+  app.currentplayerid = idnum
 
-  app.event_generate("<<RedrawTurn>>")
+  app.request_redraw('turn')
 
 def set_player_eliminated(idnum):
-  with app.boardlock:
-    with app.infolock:
-      if idnum in app.playernames:
-        playername = app.playernames[idnum]
-        app.playerlist.remove(playername)
-      else:
-        print('Unknown player eliminated: {}'.format(idnum))
-    app.playerlistvar.set(app.playerlist)
-
-    if not idnum in app.eliminatedlist:
-      app.eliminatedlist.append(idnum)
+  if idnum in app.playernames:
+    playername = app.playernames[idnum]
+    app.playerlist.remove(playername)
+  else:
+    log.warning('Unknown player eliminated: %s', idnum)
+  app.playerlistvar.set(app.playerlist)
+
+  if not idnum in app.eliminatedlist:
+    app.eliminatedlist.append(idnum)
   
-  app.event_generate("<<RedrawTokens>>")
-  app.event_generate("<<RedrawTurn>>")
+  app.dirtytokens.add(idnum)
+  app.request_redraw('tokens', 'turn')
 
 def tile_placed(msg):
-  print('tile {} at {}, {} : {} from {}'.format(msg.tileid, msg.x, msg.y, msg.rotation, msg.idnum))
-
-  with app.boardlock:
-    # we don't use board.set_tile() here, because we trust the server, and we're
-    # not worried if it sends a tile placement that looks illegal. this might
-    # legitimately happen when, e.g. we join an existing game and the server
-    # is catching us up on the current game state
-    idx = app.board.tile_index(msg.x, msg.y)
-    app.board.tileids[idx] = msg.tileid
-    app.board.tilerotations[idx] = msg.rotation
-    app.board.tileplaceids[idx] = msg.idnum
+  log.debug('tile %d at %d, %d : %d from %d', msg.tileid, msg.x, msg.y, msg.rotation, msg.idnum)
+
+  # we don't use board.set_tile() here, because we trust the server, and we're
+  # not worried if it sends a tile placement that looks illegal. this might
+  # legitimately happen when, e.g. we join an existing game and the server
+  # is catching us up on the current game state
+  idx = app.board.tile_index(msg.x, msg.y)
+  app.board.tileids[idx] = msg.tileid
+  app.board.tilerotations[idx] = msg.rotation
+  app.board.tileplaceids[idx] = msg.idnum
   
-  app.event_generate("<<RedrawBoard>>")
-
-  with app.infolock:
-    if app.idnum == msg.idnum:
-      with app.handlock:
-        selected = app.selected_hand
-
-        if app.hand[selected] != msg.tileid:
-          try:
-            selected = app.hand.index(msg.tileid)
-          except ValueError:
-            return
-        
-        app.hand[selected] = None
-        app.handrotations[selected] = 0
-      
-      app.event_generate("<<RedrawHand>>")
+  app.dirtysquares.add(idx)
+  app.request_redraw('board')
 
-      redrawtokens = False
+  if app.idnum == msg.idnum:
+    selected = app.selected_hand
 
-      with app.boardlock:
-        app.lasttilelocation = (msg.x, msg.y)
-        if app.location == None:
-          redrawtokens = True
-      
-      if redrawtokens:
-        app.event_generate("<<RedrawTokens>>")
+    if app.hand[selected] != msg.tileid:
+      try:
+        selected = app.hand.index(msg.tileid)
+      except ValueError:
+        return
+    
+    app.hand[selected] = None
+    app.handrotations[selected] = 0
+    
+    app.request_redraw('hand')
+
+    app.lasttilelocation = (msg.x, msg.y)
+    if app.location == None:
+      app.request_redraw('tokens')
 
 def token_moved(msg):
-  with app.boardlock:
-    if msg.idnum == app.idnum:
-      print('Setting own location')
-      app.location = (msg.x, msg.y, msg.position)
-    app.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+  if msg.idnum == app.idnum:
+    log.debug('Setting own location')
+    app.location = (msg.x, msg.y, msg.position)
+  app.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
   
-  app.event_generate("<<RedrawTokens>>")
+  app.dirtytokens.add(msg.idnum)
+  app.request_redraw('tokens')
 
 def add_tile_to_hand(tileid):
-  with app.handlock:
-    for i in range(len(app.hand)):
-      if app.hand[i] == None:
-        app.hand[i] = tileid
-        app.handrotations[i] = 0
-        break
-  app.event_generate("<<RedrawHand>>")
+  for i in range(len(app.hand)):
+    if app.hand[i] == None:
+      app.hand[i] = tileid
+      app.handrotations[i] = 0
+      break
+  app.request_redraw('hand')
+
+def handle_message(msg):
+  """Apply a message from the server to the game state. Called on the Tk
+  thread, by Application.poll_messages.
+  """
+  if isinstance(msg, tiles.MessageWelcome):
+    log.info('Welcome!')
+    app.idnum = msg.idnum
+    app.playernames[app.idnum] = 'Me!'
+  
+  elif isinstance(msg, tiles.MessagePlayerJoined):
+    log.debug('Player %s joined, id %d', msg.name, msg.idnum)
+    app.playernames[msg.idnum] = msg.name
+  
+  elif isinstance(msg, tiles.MessagePlayerLeft):
+    log.debug('Player id %d left', msg.idnum)
+    if msg.idnum in app.playernames:
+      del app.playernames[msg.idnum]
+  
+  elif isinstance(msg, tiles.MessageCountdown):
+    log.debug('Countdown starting...')
+  
+  elif isinstance(msg, tiles.MessageGameStart):
+    log.info('Game starting...')
+    reset_game_state()
+  
+  elif isinstance(msg, tiles.MessageAddTileToHand):
+    log.debug('Add tile %d to hand', msg.tileid)
+    add_tile_to_hand(msg.tileid)
+  
+  elif isinstance(msg, tiles.MessagePlayerTurn):
+    log.debug('Player turn: %s', msg)
+    set_player_turn(msg.idnum)
+  
+  elif isinstance(msg, tiles.MessagePlaceTile):
+    log.debug('Place tile: %s', msg)
+    tile_placed(msg)
+  
+  elif isinstance(msg, tiles.MessageMoveToken):
+    log.debug('Move token: %s', msg)
+    token_moved(msg)
+  
+  elif isinstance(msg, tiles.MessagePlayerEliminated):
+    log.debug('Player eliminated: %s', msg)
+    set_player_eliminated(msg.idnum)
+  
+  else:
+    log.warning('Unknown message: %s', msg)
 
 def communication_thread(sock):
-  buffer = bytearray()
+  decoder = MessageDecoder()
 
   while True:
     try:
       chunk = sock.recv(4096)
       if chunk:
-        # Read a chunk from the socket, and add it to the end of our buffer
-        # (in case we had a partial message in the buffer from a previous
-        # chunk, and we need the new chunk to complete it)
-        buffer.extend(chunk)
-
-        # Unpack as many messages as we can from the buffer.
-        while True:
-          msg, consumed = tiles.read_message_from_bytearray(buffer)
-          
-          if consumed:
-            buffer = buffer[consumed:]
-
-            if isinstance(msg, tiles.MessageWelcome):
-              print('Welcome!')
-              with app.infolock:
-                app.idnum = msg.idnum
-                app.playernames[app.idnum] = 'Me!'
-            
-            elif isinstance(msg, tiles.MessagePlayerJoined):
-              print('Player {} joined, id {}'.format(msg.name, msg.idnum))
-              with app.infolock:
-                app.playernames[msg.idnum] = msg.name
-            
-            elif isinstance(msg, tiles.MessagePlayerLeft):
-              print('Player id {} left'.format(msg.idnum))
-              with app.infolock:
-                if msg.idnum in app.playernames:
-                  del app.playernames[msg.idnum]
-            
-            elif isinstance(msg, tiles.MessageCountdown):
-              print('Countdown starting...')
-            
-            elif isinstance(msg, tiles.MessageGameStart):
-              print('Game starting...')
-              reset_game_state()
-            
-            elif isinstance(msg, tiles.MessageAddTileToHand):
-              print('Add tile {} to hand'.format(msg.tileid))
-              tileid = msg.tileid
-              
-              if tileid < 0 or tileid >= len(tiles.ALL_TILES):
-                raise RuntimeError('Unknown tile index {}'.format(tileid))
-              
-              add_tile_to_hand(tileid)
-            
-            elif isinstance(msg, tiles.MessagePlayerTurn):
-              print('Player turn: {}'.format(msg))
-              set_player_turn(msg.idnum)
-            
-            elif isinstance(msg, tiles.MessagePlaceTile):
-              print('Place tile: {}'.format(msg))
-              tile_placed(msg)
-            
-            elif isinstance(msg, tiles.MessageMoveToken):
-              print('Move token: {}'.format(msg))
-              token_moved(msg)
-            
-            elif isinstance(msg, tiles.MessagePlayerEliminated):
-              print('Player eliminated: {}'.format(msg))
-              set_player_eliminated(msg.idnum)
-            
-            else:
-              print('Unknown message: {}'.format(msg))
-          else:
-            break
+        # Feed the chunk to the decoder, which keeps any partial message left
+        # over from previous chunks, and pass every message it completes to
+        # the Tk thread, which applies them all at its next poll.
+        for msg in decoder.feed(chunk):
+          if isinstance(msg, tiles.MessageAddTileToHand):
+            if msg.tileid < 0 or msg.tileid >= len(tiles.ALL_TILES):
+              raise RuntimeError('Unknown tile index {}'.format(msg.tileid))
+
+          app.inbox.put(msg)
       else:
         break
     except:
       break
   
-  print('Server closed connection')
+  log.info('Server closed connection')
 
-  if not exited:
-    app.event_generate('<<CloseConnection>>')
+  # tell the Tk thread to close the window
+  app.inbox.put(None)
 
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -425,7 +542,7 @@ server_host = 'localhost'
 if len(sys.argv) > 2:
   server_host = sys.argv[1]
 
-print('Using server hostname {}'.format(server_host))
+log.info('Using server hostname %s', server_host)
 
 server_address = (server_host, 30020)
 sock.connect(server_address)
@@ -439,7 +556,7 @@ try:
   app.sock = sock
   app.mainloop()
 finally:
-  print('closing sock')
+  log.info('closing sock')
   sock.shutdown(socket.SHUT_WR)
   sock.close()
 
@@ -0,0 +1,762 @@
+# CITS3002 2021 Assignment
+#
+# This module implements a faster drop-in replacement for tiles.Board, for use
+# by the server and anything else that plays many games. It follows exactly
+# the same rules and gives exactly the same results as tiles.Board, but its
+# token movement uses a precomputed transition table instead of working out
+# each step from the tile connections.
+#
+# Each board also indexes its tokens by square, so that after a placement
+# do_player_movement_at only moves the tokens on that square. The index pays
+# off on large boards with many players, but costs every token move a little:
+# on the standard board, with only four tokens to look at anyway, movement is
+# somewhat slower than with tiles.Board (see python bench.py movement).
+#
+# Boards can also be made with other dimensions, and games played with other
+# hand sizes and player limits, by passing a Rules. The constants in tiles.py
+# (which are the defaults) are never changed.
+#
+# Each board can be packed into a compact byte string and back, and hashed
+# with Zobrist keys. A HashedBoard keeps its hash up to date as it changes,
+# for searches that look positions up by hash; a plain Board, as played by
+# the server, doesn't pay for that on every move.
+#
+# To try out moves without copying a board, call push() first: every change
+# made through the board's methods after that is journalled, and pop() undoes
+# them all again.
+#
+# The legal move generator remembers where each path across placed tiles
+# leads. As tiles are only ever added, a path only changes when the empty
+# square it ends on is filled, so only the paths ending there are forgotten
+# then. While changes are being journalled the remembered paths are neither
+# used nor updated, so that pop() never has to undo them.
+
+import argparse
+import struct
+from collections import namedtuple
+
+import tiles
+
+
+class Rules:
+  """The parameters of a game: the board size in squares, the number of tiles
+  in each player's hand, and the most players allowed in one game.
+  """
+
+  def __init__(self, width=tiles.BOARD_WIDTH, height=tiles.BOARD_HEIGHT,
+      hand_size=tiles.HAND_SIZE, player_limit=tiles.PLAYER_LIMIT):
+    # every value must fit the unsigned 16 bit fields of the messages
+    if width < 1 or height < 1 or width * height > 65536:
+      raise ValueError('invalid board size {}x{}'.format(width, height))
+    if hand_size < 1:
+      raise ValueError('invalid hand size {}'.format(hand_size))
+    if player_limit < 2 or player_limit > tiles.IDNUM_LIMIT:
+      raise ValueError('invalid player limit {}'.format(player_limit))
+
+    self.width = width
+    self.height = height
+    self.hand_size = hand_size
+    self.player_limit = player_limit
+
+  def is_standard(self):
+    """Whether these are the rules that the tiles.py clients expect."""
+    return (self.width, self.height, self.hand_size, self.player_limit) == (
+      tiles.BOARD_WIDTH, tiles.BOARD_HEIGHT, tiles.HAND_SIZE,
+      tiles.PLAYER_LIMIT)
+
+  def __repr__(self):
+    return 'Rules(width={}, height={}, hand_size={}, player_limit={})'.format(
+      self.width, self.height, self.hand_size, self.player_limit)
+
+
+STANDARD_RULES = Rules()
+
+
+def board_size(text):
+  """argparse type of the --board option: a board size WxH, as (width,
+  height), that Rules accepts.
+  """
+  width, _, height = text.partition('x')
+  try:
+    size = (int(width), int(height))
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+      'invalid board size {!r}, expected WxH'.format(text))
+  try:
+    Rules(*size)
+  except ValueError as e:
+    raise argparse.ArgumentTypeError(str(e))
+  return size
+
+
+def rules_value(name):
+  """argparse type of an option giving the value of the Rules parameter
+  name, an int that Rules accepts.
+  """
+  def parse(text):
+    try:
+      value = int(text)
+    except ValueError:
+      raise argparse.ArgumentTypeError('invalid int value: {!r}'.format(text))
+    try:
+      Rules(**{name: value})
+    except ValueError as e:
+      raise argparse.ArgumentTypeError(str(e))
+    return value
+  return parse
+
+
+def add_rules_arguments(parser):
+  """Add options for choosing the game Rules to an argparse parser. Values
+  that Rules would reject are reported by the parser as usage errors.
+  """
+  group = parser.add_argument_group('game rules',
+    'the standard client only supports the default rules')
+  group.add_argument('--board', type=board_size, default='{}x{}'.format(
+    tiles.BOARD_WIDTH, tiles.BOARD_HEIGHT), metavar='WxH',
+    help='board size (default: %(default)s)')
+  group.add_argument('--hand-size', type=rules_value('hand_size'),
+    default=tiles.HAND_SIZE, help='tiles in each hand (default: %(default)s)')
+  group.add_argument('--player-limit', type=rules_value('player_limit'),
+    default=tiles.PLAYER_LIMIT,
+    help='most players in one game (default: %(default)s)')
+
+
+def rules_from_arguments(args):
+  """The Rules chosen by the options from add_rules_arguments."""
+  width, height = args.board
+  return Rules(width, height, args.hand_size, args.player_limit)
+
+
+def transition_index(tileid, rotation, position):
+  """Index into TRANSITIONS for a token entering a tile (with the given
+  rotation) at position.
+  """
+  return (tileid << 5) | ((rotation & 3) << 3) | position
+
+
+def build_transitions():
+  """For every tile, rotation and entry position, the token's exit position
+  on that tile, the offset (dx, dy) of the square it moves into next, and the
+  position it enters that square at, as (exit, dx, dy, next entry).
+  """
+  table = [None] * (len(tiles.ALL_TILES) << 5)
+
+  for tileid, tile in enumerate(tiles.ALL_TILES):
+    for rotation in range(4):
+      for position in range(8):
+        exitposition = tile.getmovement(rotation, position)
+        dx, dy, nextposition = tiles.CONNECTION_NEIGHBOURS[exitposition]
+        table[transition_index(tileid, rotation, position)] = (exitposition,
+          dx, dy, nextposition)
+
+  return table
+
+
+TRANSITIONS = build_transitions()
+
+
+def build_distinct_rotations():
+  """For every tile, the rotations that move tokens differently from each
+  other. Of the rotations that are the same (because the tile is symmetric),
+  only the lowest is listed.
+  """
+  distinct = []
+  for tileid in range(len(tiles.ALL_TILES)):
+    seen = set()
+    rotations = []
+    for rotation in range(4):
+      exits = tuple(TRANSITIONS[transition_index(tileid, rotation, position)][0]
+        for position in range(8))
+      if exits not in seen:
+        seen.add(exits)
+        rotations.append(rotation)
+    distinct.append(tuple(rotations))
+  return distinct
+
+
+DISTINCT_ROTATIONS = build_distinct_rotations()
+
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(z):
+  """Scramble the 64 bit integer z (the splitmix64 finaliser)."""
+  z = (z + 0x9E3779B97F4A7C15) & MASK64
+  z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+  z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+  return z ^ (z >> 31)
+
+
+# keys already worked out by zobrist_key, as mix64 is slow in Python
+ZOBRIST_KEYS = {}
+ZOBRIST_KEYS_LIMIT = 1 << 20
+
+
+def zobrist_key(z):
+  key = ZOBRIST_KEYS.get(z)
+  if key == None:
+    if len(ZOBRIST_KEYS) >= ZOBRIST_KEYS_LIMIT:
+      ZOBRIST_KEYS.clear()
+    key = ZOBRIST_KEYS[z] = mix64(z)
+  return key
+
+
+def tile_key(idx, tileid, rotation, idnum):
+  """The Zobrist key of a tile on square idx, placed by idnum."""
+  return zobrist_key((((idx << 8 | tileid) << 2 | (rotation & 3)) << 17)
+    | idnum)
+
+
+def token_key(idnum, idx, position):
+  """The Zobrist key of idnum's token at position on square idx."""
+  return zobrist_key(((((idx << 17) | idnum) << 3 | position) << 1) | 1
+    | (1 << 63))
+
+
+# Board.pack() layout: a header of width, height and the number of tokens,
+# then each square, then each token in the order they were placed.
+PACKED_HEADER = struct.Struct('!HHH')
+PACKED_SQUARE = struct.Struct('!BBH')  # tileid, rotation, placer idnum
+PACKED_TOKEN = struct.Struct('!HHHB')  # idnum, x, y, position
+PACKED_EMPTY = 0xFF  # tileid and rotation of an empty square
+PACKED_NOBODY = 0xFFFF # placer idnum of an empty square
+
+# kinds of Board journal entries
+JOURNAL_TILE = 0  # (JOURNAL_TILE, square index) of a placed tile
+JOURNAL_TOKEN = 1 # (JOURNAL_TOKEN, idnum, previous position or None)
+
+
+# The result of a move for the tokens it moves.
+# position: where the moving player's token ends up, as (x, y, position), or
+#   None if the player has no token yet.
+# eliminated: whether the moving player is eliminated.
+# eliminates: the other live players that the move eliminates.
+Outcome = namedtuple('Outcome', 'position eliminated eliminates')
+
+
+class Placement(namedtuple('Placement', 'tileid rotation x y outcome')):
+  """A legal tile placement, and its Outcome."""
+  __slots__ = ()
+
+  def message(self, idnum):
+    return tiles.MessagePlaceTile(idnum, self.tileid, self.rotation, self.x,
+      self.y)
+
+
+class StartPosition(namedtuple('StartPosition', 'x y position outcome')):
+  """A legal starting position for a token, and its Outcome."""
+  __slots__ = ()
+
+  def message(self, idnum):
+    return tiles.MessageMoveToken(idnum, self.x, self.y, self.position)
+
+
+class Board(tiles.Board):
+  """A tiles.Board with a faster implementation of do_player_movement, and
+  do_player_movement_at to only move the tokens a placement can affect.
+
+  rules: the Rules giving the size of the board.
+  """
+
+  def __init__(self, rules=STANDARD_RULES):
+    super().__init__()
+    self.rules = rules
+    self.width = rules.width
+    self.height = rules.height
+    if (self.width, self.height) != (tiles.BOARD_WIDTH, tiles.BOARD_HEIGHT):
+      self.tileids = [None] * (self.width * self.height)
+      self.tilerotations = [None] * (self.width * self.height)
+      self.tileplaceids = [None] * (self.width * self.height)
+      self.tilerects = [None] * (self.width * self.height)
+    self.tokensat = {}   # square index -> idnums of the tokens on it
+    self.tokenorder = {} # idnum -> order its token was first placed in
+    self.steps = 0       # squares moved across by all tokens, for statistics
+    self.journal = []    # changes since the first push(), to be undone
+    self.marks = []      # (journal length, steps) at each push()
+    self.paths = {}      # see remember_path
+    self.pathsto = {}    # empty square index -> keys of paths ending there
+
+  def reset(self):
+    super().reset()
+    self.tokensat = {}
+    self.tokenorder = {}
+    self.steps = 0
+    self.journal = []
+    self.marks = []
+    self.paths = {}
+    self.pathsto = {}
+
+  def push(self):
+    """Start journalling changes to the board, so that pop() can undo them.
+    Pushes may be nested.
+    """
+    self.marks.append((len(self.journal), self.steps))
+
+  def pop(self):
+    """Undo every change made since the matching push(), in time proportional
+    to the number of changes.
+    """
+    length, self.steps = self.marks.pop()
+    journal = self.journal
+
+    while len(journal) > length:
+      entry = journal.pop()
+      if entry[0] == JOURNAL_TILE:
+        self.remove_tile(entry[1])
+      else:
+        self.restore_token(entry[1], entry[2])
+
+  def remove_tile(self, idx):
+    # undo the placement of the tile on square idx
+    self.tileids[idx] = None
+    self.tilerotations[idx] = None
+    self.tileplaceids[idx] = None
+
+  def full_zobrist(self):
+    """The Zobrist hash of the board, worked out from scratch: the xor of the
+    keys of every tile and token. A HashedBoard keeps this in its zobrist.
+    """
+    h = 0
+    for idx, tileid in enumerate(self.tileids):
+      if tileid != None:
+        h ^= tile_key(idx, tileid, self.tilerotations[idx],
+          self.tileplaceids[idx])
+    for idnum, (x, y, position) in self.playerpositions.items():
+      h ^= token_key(idnum, x + y * self.width, position)
+    return h
+
+  def pack(self):
+    """The whole state of the board (its size, tiles and tokens) as bytes,
+    which unpack() turns back into an equal board.
+    """
+    tokens = sorted(self.playerpositions, key=self.tokenorder.__getitem__)
+    parts = [PACKED_HEADER.pack(self.width, self.height, len(tokens))]
+
+    for idx, tileid in enumerate(self.tileids):
+      if tileid == None:
+        parts.append(PACKED_SQUARE.pack(PACKED_EMPTY, PACKED_EMPTY,
+          PACKED_NOBODY))
+      else:
+        parts.append(PACKED_SQUARE.pack(tileid, self.tilerotations[idx],
+          self.tileplaceids[idx]))
+
+    for idnum in tokens:
+      x, y, position = self.playerpositions[idnum]
+      parts.append(PACKED_TOKEN.pack(idnum, x, y, position))
+
+    return b''.join(parts)
+
+  @classmethod
+  def unpack(cls, data, rules=None):
+    """Make a board from the bytes returned by pack(). rules defaults to the
+    standard Rules resized to the packed board.
+    """
+    width, height, tokencount = PACKED_HEADER.unpack_from(data, 0)
+    if rules == None:
+      rules = STANDARD_RULES
+      if (width, height) != (rules.width, rules.height):
+        rules = Rules(width, height, rules.hand_size, rules.player_limit)
+    elif (width, height) != (rules.width, rules.height):
+      raise ValueError('packed board is {}x{}, not {}x{}'.format(width, height,
+        rules.width, rules.height))
+
+    board = cls(rules)
+    offset = PACKED_HEADER.size
+    for idx in range(width * height):
+      tileid, rotation, idnum = PACKED_SQUARE.unpack_from(data, offset)
+      offset += PACKED_SQUARE.size
+      if tileid != PACKED_EMPTY:
+        board.tileids[idx] = tileid
+        board.tilerotations[idx] = rotation
+        board.tileplaceids[idx] = idnum
+
+    for _ in range(tokencount):
+      idnum, x, y, position = PACKED_TOKEN.unpack_from(data, offset)
+      offset += PACKED_TOKEN.size
+      board.update_player_position(idnum, x, y, position)
+
+    return board
+
+  def set_tile(self, x: int, y: int, tileid: int, rotation: int, idnum: int):
+    if not super().set_tile(x, y, tileid, rotation, idnum):
+      return False
+    idx = x + y * self.width
+    if self.marks:
+      self.journal.append((JOURNAL_TILE, idx))
+    else:
+      # paths that stopped on this square now carry on across it
+      paths = self.paths
+      for key in self.pathsto.pop(idx, ()):
+        paths.pop(key, None)
+    return True
+
+  def remember_path(self, keys, end, eliminated):
+    """Remember that a token entering a square at each (square index << 3 |
+    position) in keys ends at end, (x, y, position), and whether it left the
+    board there.
+    """
+    paths = self.paths
+    path = (end, eliminated)
+    for key in keys:
+      paths[key] = path
+    if not eliminated:
+      self.pathsto.setdefault(end[0] + end[1] * self.width, []).extend(keys)
+
+  def start_positions(self, x: int, y: int):
+    """The positions on square x, y that touch the edge of the board, and so
+    that a token may start on.
+    """
+    positions = []
+    if y == self.height - 1:
+      positions += [0, 1]
+    if x == self.width - 1:
+      positions += [2, 3]
+    if y == 0:
+      positions += [4, 5]
+    if x == 0:
+      positions += [6, 7]
+    return positions
+
+  def set_player_start_position(self, idnum, x: int, y: int, position: int):
+    """As tiles.Board.set_player_start_position, but checking against the
+    edges of this board rather than the standard one.
+    """
+    if self.have_player_position(idnum):
+      return False
+
+    # does the tile exist, and does the player own it?
+    idx = self.tile_index(x, y)
+    if self.tileids[idx] == None or self.tileplaceids[idx] != idnum:
+      return False
+
+    # is position in tile valid?
+    if position not in self.start_positions(x, y):
+      return False
+
+    self.update_player_position(idnum, x, y, position)
+
+    return True
+
+  def legal_moves(self, idnum, hand, live_idnums=None):
+    """Every legal move for player idnum, holding the tileids in hand, with
+    the outcome of each.
+
+    Before the player has a token, these are the Placements of each tile on
+    each empty edge square or, once they have placed their first tile, the
+    StartPositions on that tile. After that, they are the Placements on the
+    square their token is on. Placements only include one of each tileid, and
+    one of each group of rotations that are the same for a symmetric tile.
+
+    The board is not changed or copied. Only the tokens of live_idnums (all
+    tokens, if omitted) are counted as moving.
+    """
+    position = self.playerpositions.get(idnum)
+
+    if position != None:
+      x, y, _ = position
+      return self.placements(idnum, hand, [(x, y)], live_idnums)
+
+    if idnum in self.tileplaceids:
+      idx = self.tileplaceids.index(idnum)
+      return self.start_moves(idnum, idx % self.width, idx // self.width,
+        live_idnums)
+
+    squares = [(x, y) for y in range(self.height) for x in range(self.width)
+      if (x == 0 or y == 0 or x == self.width - 1 or y == self.height - 1)
+      and self.tileids[x + y * self.width] == None]
+    return self.placements(idnum, hand, squares, live_idnums)
+
+  def placements(self, idnum, hand, squares, live_idnums):
+    moves = []
+    tileids = sorted(set(hand))
+
+    for x, y in squares:
+      idx = x + y * self.width
+      if self.tileids[idx] != None:
+        continue
+
+      waiting = [i for i in self.tokensat.get(idx, ())
+        if live_idnums == None or i in live_idnums]
+      if len(waiting) > 1:
+        waiting.sort(key=self.tokenorder.__getitem__)
+
+      for tileid in tileids:
+        for rotation in DISTINCT_ROTATIONS[tileid]:
+          moves.append(Placement(tileid, rotation, x, y,
+            self.outcome(idnum, waiting, idx, tileid, rotation)))
+
+    return moves
+
+  def start_moves(self, idnum, x, y, live_idnums):
+    moves = []
+    idx = x + y * self.width
+    tileid = self.tileids[idx]
+    rotation = self.tilerotations[idx]
+
+    # the tile is already placed, so only the new token moves
+    for position in self.start_positions(x, y):
+      final, eliminated = self.trace(x, y, position, idx, tileid, rotation)
+      moves.append(StartPosition(x, y, position,
+        Outcome(final, eliminated, ())))
+
+    return moves
+
+  def outcome(self, idnum, waiting, idx, tileid, rotation):
+    """The Outcome for idnum of placing tileid at rotation on the empty square
+    idx, where the tokens of waiting are.
+    """
+    position = None
+    eliminated = False
+    eliminates = []
+
+    for other in waiting:
+      x, y, entry = self.playerpositions[other]
+      final, out = self.trace(x, y, entry, idx, tileid, rotation)
+      if other == idnum:
+        position = final
+        eliminated = out
+      elif out:
+        eliminates.append(other)
+
+    return Outcome(position, eliminated, tuple(eliminates))
+
+  def trace(self, x, y, position, placedidx, placedtileid, placedrotation):
+    """Follow the path of a token from position on square x, y, as if the tile
+    placedtileid were on square placedidx with placedrotation. Returns the
+    token's final (x, y, position), and whether it left the board.
+
+    The parts of the path across tiles that really are placed are remembered,
+    and followed straight to their ends the next time they are reached.
+    """
+    width = self.width
+    height = self.height
+    tileids = self.tileids
+    tilerotations = self.tilerotations
+    transitions = TRANSITIONS
+    paths = None if self.marks else self.paths
+    visited = [] # keys reached on placed tiles, since last on placedidx
+    idx = x + y * width
+
+    while True:
+      if idx == placedidx:
+        # the path so far really ends here, as placedidx is empty
+        if visited:
+          self.remember_path(visited, (x, y, position), False)
+          visited = []
+        tileid = placedtileid
+        rotation = placedrotation
+      else:
+        tileid = tileids[idx]
+        if tileid == None:
+          end = (x, y, position)
+          if visited:
+            self.remember_path(visited, end, False)
+          return end, False
+
+        if paths != None:
+          key = (idx << 3) | position
+          path = paths.get(key)
+          if path != None:
+            end, eliminated = path
+            if visited:
+              self.remember_path(visited, end, eliminated)
+              visited = []
+            # carry on across the placed tile if the path stops on it
+            if eliminated or end[0] + end[1] * width != placedidx:
+              return end, eliminated
+            x, y, position = end
+            idx = placedidx
+            continue
+          visited.append(key)
+
+        rotation = tilerotations[idx]
+
+      exitposition, dx, dy, nextposition = transitions[
+        (tileid << 5) | ((rotation & 3) << 3) | position]
+
+      nx = x + dx
+      ny = y + dy
+      if nx < 0 or nx >= width or ny < 0 or ny >= height:
+        end = (x, y, exitposition)
+        if visited:
+          self.remember_path(visited, end, True)
+        return end, True
+
+      x, y, position = nx, ny, nextposition
+      idx = x + y * width
+
+  def update_player_position(self, idnum, x: int, y: int, position: int):
+    # this is called for every token moved, so tokensat is updated inline, and
+    # only when the token changes square (a token leaving the board doesn't).
+    # A moved token keeps its place in playerpositions, which is the order
+    # tokens are moved in.
+    playerpositions = self.playerpositions
+    old = playerpositions.get(idnum)
+    if self.marks:
+      self.journal.append((JOURNAL_TOKEN, idnum, old))
+    playerpositions[idnum] = (x, y, position)
+
+    tokensat = self.tokensat
+    idx = x + y * self.width
+    if old == None:
+      self.tokenorder[idnum] = len(self.tokenorder)
+    else:
+      oldidx = old[0] + old[1] * self.width
+      if oldidx == idx:
+        return
+      waiting = tokensat[oldidx]
+      if len(waiting) == 1:
+        del tokensat[oldidx]
+      else:
+        waiting.remove(idnum)
+
+    waiting = tokensat.get(idx)
+    if waiting == None:
+      tokensat[idx] = [idnum]
+    else:
+      waiting.append(idnum)
+
+  def restore_token(self, idnum, old):
+    # undo a journalled change to idnum's token, putting it back at old, or
+    # taking it off the board if old is None
+    x, y, _ = self.playerpositions[idnum]
+    idx = x + y * self.width
+    self.tokensat[idx].remove(idnum)
+    if not self.tokensat[idx]:
+      del self.tokensat[idx]
+
+    if old == None:
+      del self.playerpositions[idnum]
+      del self.tokenorder[idnum]
+    else:
+      self.playerpositions[idnum] = old
+      self.tokensat.setdefault(old[0] + old[1] * self.width, []).append(idnum)
+
+  def do_player_movement(self, live_idnums):
+    """Identical in behaviour to tiles.Board.do_player_movement: move every
+    live token that sits on a placed tile until it reaches an empty square or
+    leaves the board, and return (positionupdates, eliminated).
+    """
+    return self.move_tokens(list(self.playerpositions), live_idnums)
+
+  def do_player_movement_at(self, x: int, y: int, live_idnums):
+    """Move only the live tokens on square x, y, which must be the square a
+    tile has just been placed on (or a token just started on), and return
+    (positionupdates, eliminated) as do_player_movement does.
+
+    Live tokens only ever wait on empty squares, so these are the only tokens
+    that the placement can move, and the result is the same as that of
+    do_player_movement.
+    """
+    idnums = self.tokensat.get(x + y * self.width)
+    if not idnums:
+      return [], []
+
+    if len(idnums) > 1:
+      idnums = sorted(idnums, key=self.tokenorder.__getitem__)
+    else:
+      idnums = list(idnums)
+
+    return self.move_tokens(idnums, live_idnums)
+
+  def move_tokens(self, idnums, live_idnums):
+    """Move the tokens of those idnums which are also in live_idnums, in
+    order. Returns (positionupdates, eliminated).
+    """
+    positionupdates = []
+    eliminated = []
+    steps = 0
+
+    width = self.width
+    height = self.height
+    tileids = self.tileids
+    tilerotations = self.tilerotations
+    playerpositions = self.playerpositions
+    transitions = TRANSITIONS
+
+    for idnum in idnums:
+      # don't keep moving expired players around
+      if not idnum in live_idnums:
+        continue
+
+      x, y, position = playerpositions[idnum]
+      idx = x + y * width
+      tileid = tileids[idx]
+
+      if tileid == None:
+        continue
+
+      while True:
+        steps += 1
+        exitposition, dx, dy, nextposition = transitions[
+          (tileid << 5) | ((tilerotations[idx] & 3) << 3) | position]
+
+        nx = x + dx
+        ny = y + dy
+
+        # if that square would be off the board, we're eliminated
+        if nx < 0 or nx >= width or ny < 0 or ny >= height:
+          position = exitposition
+          eliminated.append(idnum)
+          break
+
+        x, y, position = nx, ny, nextposition
+        idx = x + y * width
+        tileid = tileids[idx]
+        if tileid == None:
+          break
+
+      self.update_player_position(idnum, x, y, position)
+      positionupdates.append(tiles.MessageMoveToken(idnum, x, y, position))
+
+    self.steps += steps
+    return positionupdates, eliminated
+
+
+class HashedBoard(Board):
+  """A Board that keeps the Zobrist hash of its tiles and tokens in zobrist,
+  updated as they change (and undone by pop()), so that positions can be told
+  apart cheaply, e.g. by a search's transposition table. The hash is equal to
+  full_zobrist() as long as the board is only changed through its methods.
+  """
+
+  def __init__(self, rules=STANDARD_RULES):
+    super().__init__(rules)
+    self.zobrist = 0
+
+  def reset(self):
+    super().reset()
+    self.zobrist = 0
+
+  @classmethod
+  def unpack(cls, data, rules=None):
+    board = super().unpack(data, rules)
+    board.zobrist = board.full_zobrist()
+    return board
+
+  def set_tile(self, x: int, y: int, tileid: int, rotation: int, idnum: int):
+    if not super().set_tile(x, y, tileid, rotation, idnum):
+      return False
+    self.zobrist ^= tile_key(x + y * self.width, tileid, rotation, idnum)
+    return True
+
+  def remove_tile(self, idx):
+    self.zobrist ^= tile_key(idx, self.tileids[idx], self.tilerotations[idx],
+      self.tileplaceids[idx])
+    super().remove_tile(idx)
+
+  def update_player_position(self, idnum, x: int, y: int, position: int):
+    old = self.playerpositions.get(idnum)
+    if old != None:
+      self.zobrist ^= token_key(idnum, old[0] + old[1] * self.width, old[2])
+    self.zobrist ^= token_key(idnum, x + y * self.width, position)
+    super().update_player_position(idnum, x, y, position)
+
+  def restore_token(self, idnum, old):
+    x, y, position = self.playerpositions[idnum]
+    self.zobrist ^= token_key(idnum, x + y * self.width, position)
+    if old != None:
+      self.zobrist ^= token_key(idnum, old[0] + old[1] * self.width, old[2])
+    super().restore_token(idnum, old)
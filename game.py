@@ -0,0 +1,195 @@
+# CITS3002 2021 Assignment
+#
+# This module implements the rules for a single game room, independently of
+# how the players are connected to the server. A room only needs each player to
+# have an idnum, a name, and a send(msg) method; the server owns the sockets and
+# feeds decoded messages into the room with handle_message(). Messages may be
+# either the tiles classes or the compact ones from messages.py, and the room
+# sends the compact ones.
+
+import random
+
+import tiles
+from engine import STANDARD_RULES, Board
+from messages import (MessageAddTileToHand, MessageGameStart,
+  MessagePlayerEliminated, MessagePlayerJoined, MessagePlayerLeft,
+  MessagePlayerTurn)
+from protocol import message_type
+
+
+PLACE_TILE = int(tiles.MessageType.PLACE_TILE)
+MOVE_TOKEN = int(tiles.MessageType.MOVE_TOKEN)
+
+
+class GameRoom:
+  """A single game between 2..rules.player_limit players.
+
+  players: the participating connections, in turn order. Each must provide
+  idnum, name and send(msg).
+  rng: a random.Random used to draw tiles (a fresh one is made if omitted).
+  rules: the engine.Rules to play by.
+  """
+
+  def __init__(self, players, rng=None, rules=STANDARD_RULES):
+    self.players = list(players)
+    self.rng = rng if rng != None else random.Random()
+    self.rules = rules
+    self.board = Board(rules)
+    self.connected = list(self.players)
+    self.live_idnums = [p.idnum for p in self.players]
+    self.hands = {p.idnum: [] for p in self.players}
+    self.placed = set() # idnums that have placed their first tile
+    self.current = None
+    self.finished = False
+    self.trace = None # a turntrace.Turn to mark the phases of a move on
+    self.recorder = None # a gamejournal.GameRecorder to record moves with
+
+  def draw_tileid(self):
+    """Get a random, valid tileid from this room's generator."""
+    return self.rng.randrange(0, len(tiles.ALL_TILES))
+
+  def broadcast(self, msg):
+    """Send msg to every player still connected to this room."""
+    for player in self.connected:
+      player.send(msg)
+
+  def start(self):
+    """Introduce the players to each other, deal their hands and start the
+    first turn.
+    """
+    for player in self.players:
+      for other in self.players:
+        player.send(MessagePlayerJoined(other.name, other.idnum))
+      player.send(MessageGameStart())
+
+    for player in self.players:
+      for _ in range(self.rules.hand_size):
+        self.give_tile(player)
+
+    self.current = self.players[0]
+    self.broadcast(MessagePlayerTurn(self.current.idnum))
+
+  def give_tile(self, player):
+    tileid = self.draw_tileid()
+    self.hands[player.idnum].append(tileid)
+    player.send(MessageAddTileToHand(tileid))
+
+  def on_board(self, x, y):
+    return 0 <= x < self.rules.width and 0 <= y < self.rules.height
+
+  def handle_message(self, player, msg):
+    """Apply a message sent by player. Messages from players whose turn it is
+    not, or that describe an illegal move, are ignored. Every field is checked
+    before the board sees it, as the board does not check its arguments.
+    """
+    if self.finished or player is not self.current:
+      return
+
+    idnum = player.idnum
+    kind = message_type(msg)
+
+    # sent by the player to put a tile onto the board (in all turns except
+    # their second)
+    if kind == PLACE_TILE:
+      if not self.on_board(msg.x, msg.y) or not 0 <= msg.rotation < 4 \
+          or not 0 <= msg.tileid < len(tiles.ALL_TILES):
+        return
+      if msg.idnum != idnum or msg.tileid not in self.hands[idnum]:
+        return
+      if idnum in self.placed and not self.board.have_player_position(idnum):
+        return
+      if not self.board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, idnum):
+        return
+
+      self.placed.add(idnum)
+      self.hands[idnum].remove(msg.tileid)
+      if self.recorder != None:
+        self.recorder.move(msg)
+
+      # notify everyone that placement was successful
+      self.broadcast(msg)
+
+      self.do_movement(msg.x, msg.y)
+
+      # pickup a new tile
+      if idnum in self.live_idnums:
+        self.give_tile(player)
+
+      self.next_turn()
+
+    # sent by the player in the second turn, to choose their token's
+    # starting path
+    elif kind == MOVE_TOKEN:
+      if not self.on_board(msg.x, msg.y) or not 0 <= msg.position < 8:
+        return
+      if msg.idnum != idnum or idnum not in self.placed:
+        return
+      if self.board.have_player_position(idnum):
+        return
+      if not self.board.set_player_start_position(idnum, msg.x, msg.y,
+          msg.position):
+        return
+      if self.recorder != None:
+        self.recorder.move(msg)
+
+      self.do_movement(msg.x, msg.y)
+      self.next_turn()
+
+  def do_movement(self, x, y):
+    """Move the live tokens after a tile was placed (or a token started) on
+    square x, y, and eliminate those that left the board.
+    """
+    if self.trace != None:
+      self.trace.mark('validate')
+
+    positionupdates, eliminated = self.board.do_player_movement_at(x, y,
+      self.live_idnums)
+
+    if self.trace != None:
+      self.trace.mark('movement')
+
+    for msg in positionupdates:
+      self.broadcast(msg)
+
+    for idnum in eliminated:
+      self.eliminate(idnum)
+
+  def eliminate(self, idnum):
+    if idnum in self.live_idnums:
+      self.live_idnums.remove(idnum)
+      self.broadcast(MessagePlayerEliminated(idnum))
+
+  def next_turn(self):
+    """Pass the turn to the next live player, or finish the game if fewer than
+    two players remain.
+    """
+    if len(self.live_idnums) < 2:
+      self.finished = True
+      return
+
+    i = self.players.index(self.current)
+    for step in range(1, len(self.players) + 1):
+      candidate = self.players[(i + step) % len(self.players)]
+      if candidate.idnum in self.live_idnums:
+        break
+
+    self.current = candidate
+    self.broadcast(MessagePlayerTurn(candidate.idnum))
+
+  def remove_player(self, player):
+    """Called when player disconnects. They are eliminated, the remaining
+    players are told they left, and the turn moves on if it was theirs.
+    """
+    if player not in self.connected:
+      return
+
+    self.connected.remove(player)
+    if self.recorder != None and not self.finished:
+      self.recorder.left(player.idnum)
+    self.eliminate(player.idnum)
+    self.broadcast(MessagePlayerLeft(player.idnum))
+
+    if not self.finished and player is self.current:
+      self.next_turn()
+    elif len(self.live_idnums) < 2:
+      self.finished = True
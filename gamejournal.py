@@ -0,0 +1,419 @@
+# CITS3002 2021 Assignment
+#
+# This module records every game the server plays to an append-only journal
+# file, and replays journals to check that every recorded game was played by
+# the rules and ended as recorded.
+#
+# A journal is a 32 byte header followed by 32 byte records, so it can be
+# memory mapped and scanned (e.g. with RECORD.iter_unpack, or by slicing out
+# every record's kind byte) without parsing it message by message. Records of
+# games played at the same time are interleaved, and told apart by the game
+# number in each. A game is:
+#   START   the seed of the room's random.Random, which chose every tile dealt,
+#           and the number of players
+#   PLAYER  one per player, in turn order
+#   MOVE    each move the room accepted, as the message's packed bytes
+#   LEFT    a player disconnecting before the end
+#   END     the winner, if any
+# Every record also has the time it was made.
+#
+# Records are buffered, and written and fsync'ed to disk by tick() according
+# to a policy: after every tick ('always'), at most every interval seconds
+# ('interval'), or only when the buffer fills, leaving syncing to the OS
+# ('never').
+#
+# Records still buffered are written by close(), which is also called when
+# the process exits normally, through atexit. A process killed outright (e.g.
+# by SIGKILL, or a signal it doesn't handle) loses them: up to one event loop
+# iteration of records with 'always', up to interval seconds with 'interval',
+# and up to batch_bytes (64 KiB) with 'never'. Records written but not yet
+# synced survive the process dying, but not the machine.
+#
+# usage: python gamejournal.py replay FILE [--engine]
+#        python gamejournal.py stats FILE
+
+import argparse
+import atexit
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from collections import namedtuple
+
+import engine
+import tiles
+from protocol import (MOVE_TOKEN, MOVE_TOKEN_STRUCT, PLACE_TILE,
+  PLACE_TILE_STRUCT, encode, message_type)
+
+
+MAGIC = b'TJNL'
+VERSION = 1
+
+# magic, version, then the rules: width, height, hand size, player limit
+HEADER = struct.Struct('<4sHIIII10x')
+# kind, value, game, time, payload
+RECORD = struct.Struct('<BxHId16s')
+SEED = struct.Struct('<Q8x')
+
+START = 1
+PLAYER = 2
+MOVE = 3
+LEFT = 4
+END = 5
+
+NOBODY = 0xFFFF # the winner of a game with none
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+class JournalError(Exception):
+  """Raised for a file that is not a journal, or was written with other
+  rules.
+  """
+
+
+class GameRecorder:
+  """Records the events of one game to a GameJournal. A GameRoom with one
+  as its recorder calls move() and left(); the server calls end().
+  """
+
+  __slots__ = ('journal', 'game')
+
+  def __init__(self, journal, game):
+    self.journal = journal
+    self.game = game
+
+  def move(self, msg):
+    """Record a tiles or compact MessagePlaceTile or MessageMoveToken."""
+    self.journal.append(MOVE, message_type(msg), self.game, encode(msg))
+
+  def left(self, idnum):
+    self.journal.append(LEFT, idnum, self.game)
+
+  def end(self, live_idnums):
+    winner = live_idnums[0] if len(live_idnums) == 1 else NOBODY
+    self.journal.append(END, winner, self.game)
+
+
+class GameJournal:
+  """An append-only journal file. If path already holds a journal, new games
+  are added after its last whole record.
+  """
+
+  def __init__(self, path, rules=engine.STANDARD_RULES, fsync='interval',
+      interval=1.0, batch_bytes=1 << 16):
+    if fsync not in FSYNC_POLICIES:
+      raise ValueError('unknown fsync policy {}'.format(fsync))
+
+    self.path = path
+    self.rules = rules
+    self.fsync = fsync
+    self.interval = interval
+    self.batch_bytes = batch_bytes
+    self.buffer = bytearray()
+    self.unsynced = False # whether anything written is yet to be fsync'ed
+    self.lastsync = time.monotonic()
+
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    size = os.fstat(self.fd).st_size
+    if size == 0:
+      os.write(self.fd, HEADER.pack(MAGIC, VERSION, rules.width, rules.height,
+        rules.hand_size, rules.player_limit))
+      self.next_game = 0
+    else:
+      self.next_game = self.recover(size)
+
+    # don't lose the buffer if the owner exits without closing the journal
+    atexit.register(self.close)
+
+  def recover(self, size):
+    """Check the header of the existing journal, drop any part of a record
+    left by a crash, and return the number of the next game.
+    """
+    header = os.pread(self.fd, HEADER.size, 0)
+    check_header(header, self.rules)
+
+    records = (size - HEADER.size) // RECORD.size
+    end = HEADER.size + records * RECORD.size
+    if end != size:
+      os.ftruncate(self.fd, end)
+
+    # the last game started has the highest number
+    for index in range(records - 1, -1, -1):
+      record = os.pread(self.fd, RECORD.size, HEADER.size + index * RECORD.size)
+      kind, _, game, _, _ = RECORD.unpack(record)
+      if kind == START:
+        return game + 1
+    return 0
+
+  def start_game(self, seed, idnums):
+    """Record the start of a game whose tiles are drawn from
+    random.Random(seed), between the players idnums (in turn order), and
+    return its GameRecorder.
+    """
+    game = self.next_game
+    self.next_game += 1
+
+    self.append(START, len(idnums), game, SEED.pack(seed))
+    for idnum in idnums:
+      self.append(PLAYER, idnum, game)
+    return GameRecorder(self, game)
+
+  def append(self, kind, value, game, payload=b''):
+    self.buffer += RECORD.pack(kind, value, game, time.time(), payload)
+
+  def tick(self):
+    """Write and sync the buffered records, as the fsync policy says. Called
+    once per iteration of the server's event loop.
+    """
+    if self.fsync == 'always':
+      self.sync()
+    elif len(self.buffer) >= self.batch_bytes:
+      self.write()
+    if self.fsync == 'interval' and (self.buffer or self.unsynced) \
+        and time.monotonic() - self.lastsync >= self.interval:
+      self.sync()
+
+  def timeout(self):
+    """How long the caller can wait before calling tick() again, or None if
+    it need not until more is recorded.
+    """
+    if self.fsync != 'interval' or not (self.buffer or self.unsynced):
+      return None
+    return max(0.0, self.lastsync + self.interval - time.monotonic())
+
+  def write(self):
+    if self.buffer:
+      # the file is only ever appended to, so this writes at its end
+      os.lseek(self.fd, 0, os.SEEK_END)
+      with memoryview(self.buffer) as data:
+        written = 0
+        while written < len(data):
+          written += os.write(self.fd, data[written:])
+      self.buffer.clear()
+      self.unsynced = True
+
+  def sync(self):
+    self.write()
+    if self.unsynced:
+      os.fsync(self.fd)
+      self.unsynced = False
+    self.lastsync = time.monotonic()
+
+  def close(self):
+    if self.fd == None:
+      return
+    if self.fsync == 'never':
+      self.write()
+    else:
+      self.sync()
+    os.close(self.fd)
+    self.fd = None
+    atexit.unregister(self.close)
+
+
+def check_header(header, rules=None):
+  """Check header is a journal header, and if rules is given, for those
+  rules. Returns the journal's engine.Rules.
+  """
+  if len(header) < HEADER.size:
+    raise JournalError('too short for a journal')
+  magic, version, width, height, hand_size, player_limit = HEADER.unpack(header)
+  if magic != MAGIC or version != VERSION:
+    raise JournalError('not a version {} journal'.format(VERSION))
+
+  recorded = engine.Rules(width, height, hand_size, player_limit)
+  if rules != None and (width, height, hand_size, player_limit) != (
+      rules.width, rules.height, rules.hand_size, rules.player_limit):
+    raise JournalError('journal was recorded with {}'.format(recorded))
+  return recorded
+
+
+GameRecord = namedtuple('GameRecord', 'game seed players events winner')
+GameRecord.__doc__ = """A game read from a journal. events is a list of
+(kind, value, payload) for its MOVE and LEFT records, in order; winner is None
+if the game never ended (e.g. the server stopped).
+"""
+
+
+class JournalReader:
+  """A journal, memory mapped for reading."""
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    self.rules = check_header(self.map[:HEADER.size])
+    self.count = (len(self.map) - HEADER.size) // RECORD.size
+
+  def records(self):
+    """Every record, as (kind, value, game, time, payload)."""
+    end = HEADER.size + self.count * RECORD.size
+    return RECORD.iter_unpack(memoryview(self.map)[HEADER.size:end])
+
+  def kinds(self):
+    """The kind of every record, as bytes, read straight from the map."""
+    end = HEADER.size + self.count * RECORD.size
+    return self.map[HEADER.size:end:RECORD.size]
+
+  def games(self):
+    """Yield a GameRecord for each game, in the order they ended (then any
+    left unfinished, in the order they started).
+    """
+    playing = {}
+    for kind, value, game, _, payload in self.records():
+      if kind == START:
+        seed, = SEED.unpack(payload)
+        playing[game] = GameRecord(game, seed, [], [], None)
+      elif kind == PLAYER:
+        playing[game].players.append(value)
+      elif kind == MOVE or kind == LEFT:
+        playing[game].events.append((kind, value, payload))
+      elif kind == END:
+        yield playing.pop(game)._replace(winner=value)
+    yield from playing.values()
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+
+class ReplayError(Exception):
+  """Raised when a recorded game could not have been played as recorded."""
+
+
+def replay_game(record, rules, make_board):
+  """Play record's moves again on make_board(), drawing tiles from its seed
+  as game.GameRoom does, and check every move was legal and the game ended as
+  recorded. Raises a ReplayError if not.
+
+  Returns the number of moves replayed, not counting players leaving.
+  """
+  rng = random.Random(record.seed)
+  tilecount = len(tiles.ALL_TILES)
+  board = make_board()
+  fast = isinstance(board, engine.Board) # only moves the tokens at x, y
+  live_idnums = list(record.players)
+  hands = {}
+  for idnum in record.players:
+    hands[idnum] = [rng.randrange(0, tilecount) for _ in range(rules.hand_size)]
+
+  moves = 0
+  for number, (kind, value, payload) in enumerate(record.events):
+    if kind == LEFT:
+      if value in live_idnums:
+        live_idnums.remove(value)
+      continue
+    moves += 1
+
+    if value == PLACE_TILE:
+      _, idnum, tileid, rotation, x, y = PLACE_TILE_STRUCT.unpack_from(payload)
+      if idnum not in hands or tileid not in hands[idnum]:
+        raise ReplayError('move {}: player {} placed tile {} not in their '
+          'hand {}'.format(number, idnum, tileid, hands.get(idnum)))
+      if not board.set_tile(x, y, tileid, rotation, idnum):
+        raise ReplayError('move {}: illegal placement of tile {} at {}, {} by '
+          'player {}'.format(number, tileid, x, y, idnum))
+      hands[idnum].remove(tileid)
+    elif value == MOVE_TOKEN:
+      _, idnum, x, y, position = MOVE_TOKEN_STRUCT.unpack_from(payload)
+      if not board.set_player_start_position(idnum, x, y, position):
+        raise ReplayError('move {}: illegal start position {} at {}, {} for '
+          'player {}'.format(number, position, x, y, idnum))
+    else:
+      raise ReplayError('move {}: unknown message type {}'.format(number, value))
+
+    if fast:
+      _, eliminated = board.do_player_movement_at(x, y, live_idnums)
+    else:
+      _, eliminated = board.do_player_movement(live_idnums)
+    for other in eliminated:
+      live_idnums.remove(other)
+
+    if value == PLACE_TILE and idnum in live_idnums:
+      hands[idnum].append(rng.randrange(0, tilecount))
+
+  winner = live_idnums[0] if len(live_idnums) == 1 else NOBODY
+  if winner != record.winner:
+    raise ReplayError('recorded winner {}, but replay won by {}'.format(
+      record.winner, winner))
+  return moves
+
+
+def replay(args):
+  """Replay every finished game in a journal, and report any that don't
+  replay as recorded.
+  """
+  reader = JournalReader(args.file)
+  rules = reader.rules
+  if args.engine:
+    make_board = lambda: engine.Board(rules)
+  elif rules.is_standard():
+    make_board = tiles.Board
+  else:
+    sys.exit('journal uses non-standard {}; replay it with --engine'
+      .format(rules))
+
+  games = 0
+  moves = 0
+  failed = 0
+  unfinished = 0
+  start = time.perf_counter()
+  for record in reader.games():
+    if record.winner == None:
+      unfinished += 1
+      continue
+    games += 1
+    try:
+      moves += replay_game(record, rules, make_board)
+    except ReplayError as e:
+      failed += 1
+      print('game {} (seed {}): {}'.format(record.game, record.seed, e))
+  elapsed = time.perf_counter() - start
+  reader.close()
+
+  print('replayed {} games, {} moves in {:.2f}s: {:.0f} games/s, {:.0f} '
+    'moves/s'.format(games, moves, elapsed, games / max(elapsed, 1e-9),
+    moves / max(elapsed, 1e-9)))
+  print('{} failed, {} unfinished'.format(failed, unfinished))
+  if failed:
+    sys.exit(1)
+
+
+def stats(args):
+  """Count the records of each kind in a journal, without unpacking them."""
+  reader = JournalReader(args.file)
+  start = time.perf_counter()
+  kinds = reader.kinds()
+  counts = {name: kinds.count(kind) for name, kind in (('games', START),
+    ('moves', MOVE), ('left', LEFT), ('ended', END))}
+  elapsed = time.perf_counter() - start
+  print('{}: {}, {} records'.format(args.file, reader.rules, reader.count))
+  for name, count in counts.items():
+    print('{:>8} {}'.format(name, count))
+  print('counted in {:.3f}s'.format(elapsed))
+  reader.close()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Game journal tools.')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  replaying = commands.add_parser('replay', help=replay.__doc__)
+  replaying.add_argument('file')
+  replaying.add_argument('--engine', action='store_true',
+    help='replay on engine.Board, as the server plays, rather than '
+    'tiles.Board; needed for journals with non-standard rules')
+  replaying.set_defaults(run=replay)
+
+  counting = commands.add_parser('stats', help=stats.__doc__)
+  counting.add_argument('file')
+  counting.set_defaults(run=stats)
+
+  args = parser.parse_args(argv[1:])
+  args.run(args)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,188 @@
+# CITS3002 2021 Assignment
+#
+# This module sets up logging for the server and clients, on top of the
+# standard logging module. Records are put on a bounded queue by the thread
+# that logs them, and formatted and written by a background thread, so
+# logging never waits on the terminal. When the queue is full, records are
+# dropped rather than slowing the game down, and the next record written
+# says how many were lost.
+#
+# Messages are formatted lazily: log.debug('received message %s', msg) costs
+# a level check when debug is off, and msg is only turned into a string by
+# the background thread. Values passed as arguments must not be changed after
+# they are logged.
+#
+# Each record is written as a line of JSON (--log-format json) or plain text.
+# Fields passed with extra={...} are included in the JSON object.
+#
+# A process forked after configure() (e.g. a server worker) gets its own queue
+# and background thread, as threads do not survive a fork.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+LEVELS = ('debug', 'info', 'warning', 'error')
+FORMATS = ('json', 'text')
+
+DEFAULT_LEVEL = os.environ.get('TILES_LOG_LEVEL', 'info')
+DEFAULT_FORMAT = os.environ.get('TILES_LOG_FORMAT', 'json')
+QUEUE_SIZE = 10000 # records waiting to be written before more are dropped
+
+# attributes every LogRecord has; any others were given with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message'}
+
+
+class JsonFormatter(logging.Formatter):
+  """Formats a record as one line of JSON, with its time, level, logger,
+  message and any extra fields.
+  """
+
+  def format(self, record):
+    entry = {
+      'time': round(record.created, 6),
+      'level': record.levelname.lower(),
+      'logger': record.name,
+      'message': record.getMessage(),
+    }
+    for key, value in vars(record).items():
+      if key not in RECORD_ATTRIBUTES:
+        entry[key] = value
+    if record.exc_text:
+      entry['exception'] = record.exc_text
+    return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+  """Formats a record as its message, with any extra fields after it."""
+
+  def format(self, record):
+    line = record.getMessage()
+    extras = ['{}={}'.format(key, value) for key, value in vars(record).items()
+      if key not in RECORD_ATTRIBUTES]
+    if extras:
+      line += ' ' + ' '.join(extras)
+    if record.exc_text:
+      line += '\n' + record.exc_text
+    return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  """A QueueHandler that drops records when more than capacity are waiting,
+  instead of blocking, and leaves formatting to the thread that writes them.
+
+  records is a queue.SimpleQueue, which (unlike queue.Queue) takes no lock to
+  put a record, so capacity is only checked approximately.
+  """
+
+  def __init__(self, records, capacity=QUEUE_SIZE):
+    super().__init__(records)
+    self.capacity = capacity
+    self.dropped = 0 # records dropped since the last one queued
+    self.total_dropped = 0
+
+  def handle(self, record):
+    # the queue is thread safe, so skip the handler's lock
+    if self.filter(record):
+      self.enqueue(self.prepare(record))
+    return record
+
+  def prepare(self, record):
+    # tracebacks can't wait for the background thread
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+    if self.dropped:
+      record.dropped = self.dropped
+    return record
+
+  def enqueue(self, record):
+    if self.queue.qsize() >= self.capacity:
+      self.dropped += 1
+      self.total_dropped += 1
+    else:
+      self.queue.put(record)
+      self.dropped = 0
+
+
+listener = None
+settings = None # the arguments of the last call to configure
+
+
+def configure(level=None, format=None, stream=None, queue_size=QUEUE_SIZE):
+  """Send the records of every logger at level or above to stream (default
+  stdout) through a background thread, formatted as format ('json' or
+  'text'). level and format default to the TILES_LOG_LEVEL and
+  TILES_LOG_FORMAT environment variables, or info and json.
+
+  Calling configure again replaces the previous configuration.
+  """
+  global listener, settings
+  shutdown()
+  settings = (level, format, stream, queue_size)
+
+  level = (level or DEFAULT_LEVEL).lower()
+  format = (format or DEFAULT_FORMAT).lower()
+  if level not in LEVELS:
+    raise ValueError('unknown log level {}'.format(level))
+  if format not in FORMATS:
+    raise ValueError('unknown log format {}'.format(format))
+
+  # neither format writes the caller, thread or process of a record, so don't
+  # spend time finding them out for every record made
+  logging._srcfile = None
+  logging.logThreads = False
+  logging.logProcesses = False
+  logging.logMultiprocessing = False
+
+  output = logging.StreamHandler(stream if stream != None else sys.stdout)
+  output.setFormatter(JsonFormatter() if format == 'json' else TextFormatter())
+
+  records = queue.SimpleQueue()
+  root = logging.getLogger()
+  for handler in list(root.handlers):
+    root.removeHandler(handler)
+  root.addHandler(DroppingQueueHandler(records, queue_size))
+  root.setLevel(level.upper())
+
+  listener = logging.handlers.QueueListener(records, output)
+  listener.start()
+
+
+def shutdown():
+  """Write every record still queued, and stop the background thread."""
+  global listener
+  if listener != None:
+    listener.stop()
+    listener = None
+
+
+def restart_in_child():
+  """After a fork, start a new queue and background thread in the child."""
+  global listener
+  if listener != None:
+    listener = None
+    configure(*settings)
+
+
+atexit.register(shutdown)
+os.register_at_fork(after_in_child=restart_in_child)
+
+
+def add_logging_arguments(parser):
+  """Add --log-level and --log-format to an argparse parser."""
+  parser.add_argument('--log-level', choices=LEVELS, default=DEFAULT_LEVEL,
+    help='least important messages to log (default: %(default)s)')
+  parser.add_argument('--log-format', choices=FORMATS, default=DEFAULT_FORMAT,
+    help='write each message as plain text or a line of JSON '
+    '(default: %(default)s)')
+
+
+def configure_from_arguments(args):
+  """configure() from the arguments added by add_logging_arguments."""
+  configure(args.log_level, args.log_format)
@@ -0,0 +1,166 @@
+# CITS3002 2021 Assignment
+#
+# This module defines compact equivalents of the message classes in tiles.py,
+# for the server's hot path. Each is a namedtuple, so instances have no
+# __dict__ and are much smaller and cheaper to create than the tiles classes,
+# but they pack to exactly the same bytes. They can also pack themselves
+# straight into a preallocated buffer with pack_into().
+#
+# Unlike the tiles classes, these messages are immutable.
+
+import struct
+from collections import namedtuple
+
+import tiles
+
+
+class CompactMessage:
+  """Behaviour shared by all of the compact messages. Subclasses define TYPE
+  (the tiles.MessageType value, as a plain int) and STRUCT (their layout,
+  including the type), and list their fields in wire order.
+  """
+
+  __slots__ = ()
+
+  TYPE = None
+  STRUCT = None
+
+  @property
+  def size(self):
+    """The number of bytes this message packs to."""
+    return self.STRUCT.size
+
+  def pack(self):
+    return self.STRUCT.pack(self.TYPE, *self)
+
+  def pack_into(self, buffer, offset):
+    """Pack this message into buffer at offset, and return the number of
+    bytes written.
+    """
+    self.STRUCT.pack_into(buffer, offset, self.TYPE, *self)
+    return self.STRUCT.size
+
+
+class MessageWelcome(CompactMessage, namedtuple('MessageWelcome', 'idnum')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.WELCOME)
+  STRUCT = struct.Struct('!HH')
+
+  def __str__(self):
+    return f"Welcome to the game! your ID is {self.idnum}."
+
+
+class MessagePlayerJoined(CompactMessage,
+    namedtuple('MessagePlayerJoined', 'name idnum')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.PLAYER_JOINED)
+  STRUCT = struct.Struct('!HHH') # followed by the name
+
+  def encoded_name(self):
+    if isinstance(self.name, str):
+      return bytes(self.name, 'utf-8')
+    return bytes(self.name)
+
+  @property
+  def size(self):
+    return self.STRUCT.size + len(self.encoded_name())
+
+  def pack(self):
+    name = self.encoded_name()
+    return self.STRUCT.pack(self.TYPE, self.idnum, len(name)) + name
+
+  def pack_into(self, buffer, offset):
+    name = self.encoded_name()
+    self.STRUCT.pack_into(buffer, offset, self.TYPE, self.idnum, len(name))
+    start = offset + self.STRUCT.size
+    buffer[start:start + len(name)] = name
+    return self.STRUCT.size + len(name)
+
+  def __str__(self):
+    return f"Player {self.name} has joined the game!"
+
+
+class MessagePlayerLeft(CompactMessage,
+    namedtuple('MessagePlayerLeft', 'idnum')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.PLAYER_LEFT)
+  STRUCT = struct.Struct('!HH')
+
+  def __str__(self):
+    return f"A player has left the game."
+
+
+class MessageCountdown(CompactMessage, namedtuple('MessageCountdown', '')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.COUNTDOWN_STARTED)
+  STRUCT = struct.Struct('!H')
+
+
+class MessageGameStart(CompactMessage, namedtuple('MessageGameStart', '')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.GAME_START)
+  STRUCT = struct.Struct('!H')
+
+
+class MessageAddTileToHand(CompactMessage,
+    namedtuple('MessageAddTileToHand', 'tileid')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.ADD_TILE_TO_HAND)
+  STRUCT = struct.Struct('!HH')
+
+  def __str__(self):
+    return "Tiles are now added to your hand!"
+
+
+class MessagePlayerTurn(CompactMessage,
+    namedtuple('MessagePlayerTurn', 'idnum')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.PLAYER_TURN)
+  STRUCT = struct.Struct('!HH')
+
+  def __str__(self):
+    return "A new turn has started!"
+
+
+class MessagePlaceTile(CompactMessage,
+    namedtuple('MessagePlaceTile', 'idnum tileid rotation x y')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.PLACE_TILE)
+  STRUCT = struct.Struct('!HHHHHH')
+
+  def __str__(self):
+    return "A player placed his/her tile!"
+
+
+class MessageMoveToken(CompactMessage,
+    namedtuple('MessageMoveToken', 'idnum x y position')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.MOVE_TOKEN)
+  STRUCT = struct.Struct('!HHHHH')
+
+  def __str__(self):
+    return "Player has decided its starting position!"
+
+
+class MessagePlayerEliminated(CompactMessage,
+    namedtuple('MessagePlayerEliminated', 'idnum')):
+  __slots__ = ()
+  TYPE = int(tiles.MessageType.PLAYER_ELIMINATED)
+  STRUCT = struct.Struct('!HH')
+
+  def __str__(self):
+    return "A player has been eliminated!"
+
+
+ALL_MESSAGES = [
+  MessageWelcome,
+  MessagePlayerJoined,
+  MessagePlayerLeft,
+  MessageCountdown,
+  MessageGameStart,
+  MessageAddTileToHand,
+  MessagePlayerTurn,
+  MessagePlaceTile,
+  MessageMoveToken,
+  MessagePlayerEliminated,
+]
@@ -0,0 +1,226 @@
+# CITS3002 2021 Assignment
+#
+# This module keeps counters, gauges and histograms for the server, and serves
+# them over HTTP in the Prometheus text exposition format, so a running server
+# can be watched (e.g. with curl http://localhost:9100/metrics) or scraped.
+#
+# Updating a metric is a dict or list increment, cheap enough for every
+# message the server handles. Gauges are read from a function only when the
+# metrics are scraped, so they cost nothing in between.
+#
+# The endpoint is served by the server's own selector event loop, like every
+# other socket, so metrics are never read while they are being updated and
+# need no locks.
+
+import bisect
+import selectors
+import socket
+
+
+def format_value(value):
+  if isinstance(value, float):
+    if value == float('inf'):
+      return '+Inf'
+    return repr(value)
+  return str(value)
+
+
+class Counter:
+  """A count that only goes up, e.g. of messages received. A counter with a
+  label keeps a separate count for each key given to inc(); labelname is the
+  label's name, and labelvalue turns a key into its value in the output.
+  """
+
+  kind = 'counter'
+
+  def __init__(self, name, help, labelname=None, labelvalue=str):
+    self.name = name
+    self.help = help
+    self.labelname = labelname
+    self.labelvalue = labelvalue
+    self.values = {}
+
+  def inc(self, key=None, amount=1):
+    values = self.values
+    values[key] = values.get(key, 0) + amount
+
+  def samples(self):
+    if self.labelname == None:
+      yield self.name, self.values.get(None, 0)
+      return
+
+    for key, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+      yield '{}{{{}="{}"}}'.format(self.name, self.labelname,
+        self.labelvalue(key)), value
+
+
+class Gauge:
+  """A value that can go up and down, e.g. the games running, read from
+  function() each time the metrics are scraped.
+  """
+
+  kind = 'gauge'
+
+  def __init__(self, name, help, function):
+    self.name = name
+    self.help = help
+    self.function = function
+
+  def samples(self):
+    yield self.name, self.function()
+
+
+class Histogram:
+  """The distribution of observed values, counted in buckets with the given
+  upper bounds (in increasing order), along with their sum and count.
+  """
+
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets):
+    self.name = name
+    self.help = help
+    self.buckets = list(buckets) + [float('inf')]
+    self.counts = [0] * len(self.buckets)
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def samples(self):
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      yield '{}_bucket{{le="{}"}}'.format(self.name, format_value(bound)), total
+    yield self.name + '_sum', self.sum
+    yield self.name + '_count', self.count
+
+
+class Registry:
+  """A named collection of metrics, rendered together by exposition()."""
+
+  def __init__(self):
+    self.metrics = []
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def counter(self, name, help, labelname=None, labelvalue=str):
+    return self.add(Counter(name, help, labelname, labelvalue))
+
+  def gauge(self, name, help, function):
+    return self.add(Gauge(name, help, function))
+
+  def histogram(self, name, help, buckets):
+    return self.add(Histogram(name, help, buckets))
+
+  def exposition(self):
+    """Every metric in the text exposition format, as a str."""
+    lines = []
+    for metric in self.metrics:
+      lines.append('# HELP {} {}'.format(metric.name, metric.help))
+      lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+      for name, value in metric.samples():
+        lines.append('{} {}'.format(name, format_value(value)))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class MetricsEndpoint:
+  """A minimal HTTP server for a Registry, run on a selector shared with
+  other sockets. Every request, whatever its path, is answered with the
+  registry's exposition and the connection is closed.
+
+  The owner of the selector calls handle_event(mask) on the data of any key
+  that is a MetricsEndpoint or ScrapeConnection.
+  """
+
+  def __init__(self, registry, selector, address=('127.0.0.1', 9100)):
+    self.registry = registry
+    self.selector = selector
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(address)
+    self.listener.listen(16)
+    self.listener.setblocking(False)
+    selector.register(self.listener, selectors.EVENT_READ, self)
+
+  def handle_event(self, mask):
+    while True:
+      try:
+        sock, _ = self.listener.accept()
+      except (BlockingIOError, InterruptedError):
+        return
+      sock.setblocking(False)
+      ScrapeConnection(self, sock)
+
+  def close(self):
+    self.selector.unregister(self.listener)
+    self.listener.close()
+
+
+class ScrapeConnection:
+  """One HTTP request to a MetricsEndpoint: read until the end of the
+  request's headers, then write the response and close.
+  """
+
+  MAX_REQUEST = 8192 # bytes; longer requests are dropped
+
+  def __init__(self, endpoint, sock):
+    self.endpoint = endpoint
+    self.sock = sock
+    self.request = bytearray()
+    self.response = None
+    endpoint.selector.register(sock, selectors.EVENT_READ, self)
+
+  def handle_event(self, mask):
+    if self.response == None:
+      self.read()
+    else:
+      self.write()
+
+  def read(self):
+    try:
+      chunk = self.sock.recv(4096)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      chunk = b''
+
+    if not chunk or len(self.request) + len(chunk) > ScrapeConnection.MAX_REQUEST:
+      self.close()
+      return
+
+    self.request += chunk
+    if b'\r\n\r\n' not in self.request and b'\n\n' not in self.request:
+      return
+
+    body = self.endpoint.registry.exposition().encode()
+    header = ('HTTP/1.0 200 OK\r\n'
+      'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+      'Content-Length: {}\r\n'
+      'Connection: close\r\n\r\n').format(len(body))
+    self.response = header.encode() + body
+    self.endpoint.selector.modify(self.sock, selectors.EVENT_WRITE, self)
+    self.write()
+
+  def write(self):
+    try:
+      sent = self.sock.send(self.response)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      self.close()
+      return
+
+    self.response = self.response[sent:]
+    if not self.response:
+      self.close()
+
+  def close(self):
+    self.endpoint.selector.unregister(self.sock)
+    self.sock.close()
@@ -0,0 +1,282 @@
+# CITS3002 2021 Assignment
+#
+# This module holds helpers for reading and writing the message stream defined
+# in tiles.py. It does not change the wire format in any way; everything here
+# interoperates with peers that only use tiles.py.
+
+import struct
+from functools import partial
+
+import messages
+import tiles
+
+
+class ProtocolError(Exception):
+  """Raised when a peer sends bytes that cannot be a valid message."""
+
+
+TYPE_STRUCT = struct.Struct('!H')
+JOINED_STRUCT = struct.Struct('!2xHH') # idnum, name length
+
+# The fixed size messages and their fields in wire order. Each class is
+# constructed with its fields in this same order.
+FIXED_MESSAGES = [
+  (tiles.MessageType.WELCOME, tiles.MessageWelcome, ('idnum',)),
+  (tiles.MessageType.PLAYER_LEFT, tiles.MessagePlayerLeft, ('idnum',)),
+  (tiles.MessageType.COUNTDOWN_STARTED, tiles.MessageCountdown, ()),
+  (tiles.MessageType.GAME_START, tiles.MessageGameStart, ()),
+  (tiles.MessageType.ADD_TILE_TO_HAND, tiles.MessageAddTileToHand, ('tileid',)),
+  (tiles.MessageType.PLAYER_TURN, tiles.MessagePlayerTurn, ('idnum',)),
+  (tiles.MessageType.PLACE_TILE, tiles.MessagePlaceTile,
+    ('idnum', 'tileid', 'rotation', 'x', 'y')),
+  (tiles.MessageType.MOVE_TOKEN, tiles.MessageMoveToken,
+    ('idnum', 'x', 'y', 'position')),
+  (tiles.MessageType.PLAYER_ELIMINATED, tiles.MessagePlayerEliminated,
+    ('idnum',)),
+]
+
+MESSAGE_TYPES = frozenset(int(t) for t in tiles.MessageType)
+
+# type id -> (struct skipping over the type, constructor)
+DECODERS = {int(typeid): (struct.Struct('!2x' + 'H' * len(fields)), cls)
+  for typeid, cls, fields in FIXED_MESSAGES}
+
+# the same, but making the compact messages from messages.py. These are
+# constructed straight from the tuple of unpacked fields.
+COMPACT_DECODERS = {cls.TYPE: (struct.Struct('!2x' + 'H' * len(cls._fields)),
+  partial(tuple.__new__, cls)) for cls in messages.ALL_MESSAGES
+  if cls is not messages.MessagePlayerJoined}
+
+# message class (from either tiles or messages) -> type id
+TYPE_OF = {cls: int(typeid) for typeid, cls, fields in FIXED_MESSAGES}
+TYPE_OF[tiles.MessagePlayerJoined] = int(tiles.MessageType.PLAYER_JOINED)
+TYPE_OF.update((cls, cls.TYPE) for cls in messages.ALL_MESSAGES)
+
+# plain int copies of the tiles.MessageType values, which pack faster
+WELCOME = int(tiles.MessageType.WELCOME)
+PLAYER_JOINED = int(tiles.MessageType.PLAYER_JOINED)
+PLAYER_LEFT = int(tiles.MessageType.PLAYER_LEFT)
+COUNTDOWN_STARTED = int(tiles.MessageType.COUNTDOWN_STARTED)
+GAME_START = int(tiles.MessageType.GAME_START)
+ADD_TILE_TO_HAND = int(tiles.MessageType.ADD_TILE_TO_HAND)
+PLAYER_TURN = int(tiles.MessageType.PLAYER_TURN)
+PLACE_TILE = int(tiles.MessageType.PLACE_TILE)
+MOVE_TOKEN = int(tiles.MessageType.MOVE_TOKEN)
+PLAYER_ELIMINATED = int(tiles.MessageType.PLAYER_ELIMINATED)
+
+ID_STRUCT = struct.Struct('!HH')
+PLACE_TILE_STRUCT = struct.Struct('!HHHHHH')
+MOVE_TOKEN_STRUCT = struct.Struct('!HHHHH')
+
+# message class -> function returning its packed bytes. The fields are read
+# directly rather than through a generic getter, as this is measurably faster.
+ENCODERS = {
+  tiles.MessageWelcome: lambda msg, pack=ID_STRUCT.pack:
+    pack(WELCOME, msg.idnum),
+  tiles.MessagePlayerLeft: lambda msg, pack=ID_STRUCT.pack:
+    pack(PLAYER_LEFT, msg.idnum),
+  tiles.MessageCountdown: lambda msg, packed=TYPE_STRUCT.pack(COUNTDOWN_STARTED):
+    packed,
+  tiles.MessageGameStart: lambda msg, packed=TYPE_STRUCT.pack(GAME_START):
+    packed,
+  tiles.MessageAddTileToHand: lambda msg, pack=ID_STRUCT.pack:
+    pack(ADD_TILE_TO_HAND, msg.tileid),
+  tiles.MessagePlayerTurn: lambda msg, pack=ID_STRUCT.pack:
+    pack(PLAYER_TURN, msg.idnum),
+  tiles.MessagePlaceTile: lambda msg, pack=PLACE_TILE_STRUCT.pack:
+    pack(PLACE_TILE, msg.idnum, msg.tileid, msg.rotation, msg.x, msg.y),
+  tiles.MessageMoveToken: lambda msg, pack=MOVE_TOKEN_STRUCT.pack:
+    pack(MOVE_TOKEN, msg.idnum, msg.x, msg.y, msg.position),
+  tiles.MessagePlayerEliminated: lambda msg, pack=ID_STRUCT.pack:
+    pack(PLAYER_ELIMINATED, msg.idnum),
+}
+ENCODERS.update((cls, cls.pack) for cls in messages.ALL_MESSAGES)
+
+# tiles.MessagePlayerJoined.pack() fails for the (bytes) names it decodes, so
+# pack it like the compact message, which accepts either
+ENCODERS[tiles.MessagePlayerJoined] = lambda msg: \
+  messages.MessagePlayerJoined(msg.name, msg.idnum).pack()
+
+
+def message_type(msg):
+  """The tiles.MessageType value of msg (as an int), which may be one of the
+  tiles or the compact message classes. Returns None for anything else.
+  """
+  return TYPE_OF.get(type(msg))
+
+
+def read_message(bs, offset=0, compact=False):
+  """Equivalent to tiles.read_message_from_bytearray, but reads the message
+  that starts at offset in bs, so a caller holding a buffer of many messages
+  never has to slice it. Returns (msg, number_of_bytes_consumed), or (None, 0)
+  if bs does not hold a complete message at offset.
+
+  compact: return the compact classes from messages.py, rather than the tiles
+  classes.
+  """
+  end = len(bs)
+  if offset + 2 > end:
+    return None, 0
+
+  typeint, = TYPE_STRUCT.unpack_from(bs, offset)
+
+  if compact:
+    decoder = COMPACT_DECODERS.get(typeint)
+    if decoder != None:
+      layout, make = decoder
+      if offset + layout.size > end:
+        return None, 0
+      return make(layout.unpack_from(bs, offset)), layout.size
+  else:
+    decoder = DECODERS.get(typeint)
+    if decoder != None:
+      layout, make = decoder
+      if offset + layout.size > end:
+        return None, 0
+      return make(*layout.unpack_from(bs, offset)), layout.size
+
+  if typeint == tiles.MessageType.PLAYER_JOINED:
+    headerlen = JOINED_STRUCT.size
+    if offset + headerlen > end:
+      return None, 0
+    idnum, namelen = JOINED_STRUCT.unpack_from(bs, offset)
+    if offset + headerlen + namelen > end:
+      return None, 0
+    name = bytes(bs[offset + headerlen:offset + headerlen + namelen])
+    if compact:
+      return messages.MessagePlayerJoined(name, idnum), headerlen + namelen
+    return tiles.MessagePlayerJoined(name, idnum), headerlen + namelen
+
+  return None, 0
+
+
+def encode(msg):
+  """Equivalent to msg.pack(), for any of the message classes in tiles or
+  messages.
+  """
+  encoder = ENCODERS.get(type(msg))
+  if encoder == None:
+    return msg.pack()
+  return encoder(msg)
+
+
+class MessageDecoder:
+  """Incrementally decodes a stream of messages, as chunks of it arrive.
+
+  Received bytes are appended to one buffer, and messages are read in place
+  from a moving offset into it (through a memoryview), so decoding a message
+  never copies the bytes that follow it. The consumed prefix is only discarded
+  once the buffer has been emptied, or the offset passes compact_threshold
+  bytes, so the cost of decoding a burst is linear in its size.
+  """
+
+  def __init__(self, compact_threshold=1 << 16, compact=False):
+    """compact: decode into the compact classes from messages.py, rather
+    than the tiles classes.
+    """
+    self.buffer = bytearray()
+    self.offset = 0
+    self.compact_threshold = compact_threshold
+    self.compact = compact
+
+  def pending(self):
+    """The number of bytes received that are not yet part of a message."""
+    return len(self.buffer) - self.offset
+
+  def feed(self, chunk):
+    """Add chunk to the end of the stream, and return a list of all of the
+    messages that are now complete, in order.
+
+    Raises ProtocolError if the next message in the stream has an unknown
+    type.
+    """
+    self.buffer += chunk
+
+    msgs = []
+    offset = self.offset
+    end = len(self.buffer)
+    compact = self.compact
+
+    with memoryview(self.buffer) as view:
+      while offset < end:
+        msg, consumed = read_message(view, offset, compact)
+        if not consumed:
+          break
+        msgs.append(msg)
+        offset += consumed
+
+      # a message that can't be decoded is reported once the messages before
+      # it have been returned
+      if not msgs and offset + TYPE_STRUCT.size <= end:
+        typeint, = TYPE_STRUCT.unpack_from(view, offset)
+        if typeint not in MESSAGE_TYPES:
+          raise ProtocolError('unknown message type {}'.format(typeint))
+
+    if offset == end:
+      self.buffer.clear()
+      offset = 0
+    elif offset >= self.compact_threshold:
+      del self.buffer[:offset]
+      offset = 0
+
+    self.offset = offset
+    return msgs
+
+
+class OutputBuffer:
+  """Bytes waiting to be sent on one connection, held in a preallocated
+  bytearray that is reused rather than reallocated. Compact messages pack
+  themselves straight into it; other messages are encoded and copied in.
+
+  Bytes are taken from the front with view() and consume().
+  """
+
+  def __init__(self, capacity=4096):
+    self.data = bytearray(capacity)
+    self.start = 0
+    self.end = 0
+
+  def __len__(self):
+    return self.end - self.start
+
+  def reserve(self, size):
+    """Make room for size more bytes at the end of the buffer."""
+    if self.end + size <= len(self.data):
+      return
+
+    # move the unsent bytes to the front, and only grow if that isn't enough
+    pending = self.end - self.start
+    if self.start:
+      self.data[:pending] = self.data[self.start:self.end]
+      self.start = 0
+      self.end = pending
+
+    if pending + size > len(self.data):
+      self.data.extend(bytes(max(len(self.data), size)))
+
+  def write(self, msg):
+    if isinstance(msg, messages.CompactMessage):
+      self.reserve(msg.size)
+      self.end += msg.pack_into(self.data, self.end)
+    else:
+      packed = encode(msg)
+      self.reserve(len(packed))
+      self.data[self.end:self.end + len(packed)] = packed
+      self.end += len(packed)
+
+  def view(self):
+    """A memoryview of the bytes waiting to be sent. It must be released
+    before anything else is written.
+    """
+    return memoryview(self.data)[self.start:self.end]
+
+  def consume(self, count):
+    """Discard count bytes from the front, once they have been sent."""
+    self.start += count
+    if self.start == self.end:
+      self.start = 0
+      self.end = 0
+
+  def clear(self):
+    self.start = 0
+    self.end = 0
@@ -1,119 +1,594 @@
 # CITS3002 2021 Assignment
 #
-# This file implements a basic server that allows a single client to play a
-# single game with no other participants, and very little error checking.
+# This file implements the game server. All connected clients are added to a
+# pool of players (the lobby). When enough players are available (two or more),
+# the server creates a game with up to rules.player_limit of the longest waiting
+# players. Many games may run at once; when a game is finished its remaining
+# players go back to the lobby to be matched into a new game.
 #
-# Any other clients that connect during this time will need to wait for the
-# first client's game to complete.
+# Every socket is non-blocking and owned by a single selectors (epoll) event
+# loop, so one slow or idle client never holds up any other. To use more than
+# one core, run with --workers N: N worker processes each run their own event
+# loop and games, sharing the listening port with SO_REUSEPORT so the kernel
+# spreads new connections between them.
 #
-# Your task will be to write a new server that adds all connected clients into
-# a pool of players. When enough players are available (two or more), the server
-# will create a game with a random sample of those players (no more than
-# tiles.PLAYER_LIMIT players will be in any one game). Players will take turns
-# in an order determined by the server, continuing until the game is finished
-# (there are less than two players remaining). When the game is finished, if
-# there are enough players available the server will start a new game with a
-# new selection of clients.
+# With --metrics-port, each worker also serves its counters and histograms
+# (see metrics.py) over HTTP on that port plus its worker number.
+#
+# Logging goes through jsonlog.py. Every message received is logged at debug
+# level, which is off by default (--log-level debug turns it on).
+#
+# --trace FILE writes the time taken by each phase of every turn to FILE, and
+# --profile FILE profiles the game rooms' code (see turntrace.py).
+#
+# --journal FILE records every game to FILE, to be replayed and checked with
+# gamejournal.py.
 
+import argparse
+import logging
+import multiprocessing
+import random
+import selectors
+import signal
 import socket
 import sys
+import time
+from collections import deque
+
+import gamejournal
+import jsonlog
 import tiles
+import turntrace
+from engine import STANDARD_RULES, add_rules_arguments, rules_from_arguments
+from game import GameRoom
+from metrics import MetricsEndpoint, Registry
+from protocol import MessageDecoder, OutputBuffer, ProtocolError, message_type
 
 
-def client_handler(connection, address):
-  host, port = address
-  name = '{}:{}'.format(host, port)
+log = logging.getLogger('server')
 
-  idnum = 0
-  live_idnums = [idnum]
+# upper bounds of the histogram buckets: seconds taken to apply a move, and
+# bytes waiting in a connection's output buffer when it is flushed
+TURN_SECONDS_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+  0.005, 0.01, 0.025, 0.1)
+SEND_QUEUE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
 
-  connection.send(tiles.MessageWelcome(idnum).pack())
-  connection.send(tiles.MessagePlayerJoined(name, idnum).pack())
-  connection.send(tiles.MessageGameStart().pack())
 
-  for _ in range(tiles.HAND_SIZE):
-    tileid = tiles.get_random_tileid()
-    connection.send(tiles.MessageAddTileToHand(tileid).pack())
-  
-  connection.send(tiles.MessagePlayerTurn(idnum).pack())
-  
-  board = tiles.Board()
+def message_type_name(typeid):
+  if typeid == None:
+    return 'unknown'
+  return tiles.MessageType(typeid).name.lower()
 
-  buffer = bytearray()
 
-  while True:
-    chunk = connection.recv(4096)
-    if not chunk:
-      print('client {} disconnected'.format(address))
+class Connection:
+  """Per-client state: the socket, a decoder holding bytes received but not
+  yet decoded, a buffer of bytes waiting to be written, and the room (if any)
+  the client is playing in.
+  """
+
+  def __init__(self, server, sock, address, idnum):
+    host, port = address[:2]
+    self.server = server
+    self.sock = sock
+    self.address = address
+    self.idnum = idnum
+    self.name = '{}:{}'.format(host, port)
+    self.decoder = MessageDecoder(compact=True)
+    self.outbuf = OutputBuffer()
+    self.room = None
+    self.closed = False
+
+  def send(self, msg):
+    """Queue msg for this client. Everything queued while handling one round
+    of events (e.g. a whole turn) is written together by Server.flush_pending,
+    in a single send per client.
+    """
+    if self.closed:
       return
 
-    buffer.extend(chunk)
+    if not self.outbuf:
+      self.server.pending.append(self)
+    self.outbuf.write(msg)
+    self.server.messages_sent.inc(message_type(msg))
+
+
+class Server:
+  """A single threaded game server, multiplexing every client socket (and the
+  listening socket) with a selector.
+  """
+
+  def __init__(self, address=('', 30020), backlog=128, listener=None,
+      reuseport=False, gamecounts=None, worker=0, rules=STANDARD_RULES,
+      metrics_address=None, tracer=None, profiler=None, journal=None):
+    """address, backlog: where to listen, unless an already listening socket
+    is given as listener.
+    reuseport: set SO_REUSEPORT, so other processes can bind the same port.
+    gamecounts, worker: a shared array, and this server's slot in it, to keep
+    up to date with the number of games running.
+    rules: the engine.Rules that every game is played by.
+    metrics_address: where to serve the server's metrics over HTTP, if at all.
+    tracer, profiler: a turntrace.Tracer to record the phases of every turn
+    with, and a turntrace.RoomProfiler to profile the game rooms with, if any.
+    journal: a gamejournal.GameJournal to record every game to, if any.
+    """
+    self.rules = rules
+    self.selector = selectors.DefaultSelector()
+    if listener == None:
+      listener = make_listener(address, backlog, reuseport)
+    self.listener = listener
+    self.listener.setblocking(False)
+    self.selector.register(self.listener, selectors.EVENT_READ, None)
+
+    self.connections = {} # idnum -> Connection
+    self.lobby = deque()  # connections waiting for a game, longest first
+    self.rooms = set()
+    self.dead = []        # connections to close at the end of this iteration
+    self.pending = []     # connections with newly queued outgoing messages
+    self.next_idnum = 0
+    self.free_idnums = []
+    self.gamecounts = gamecounts
+    self.worker = worker
 
+    self.metrics = Registry()
+    self.add_metrics(self.metrics)
+    self.metrics_endpoint = None
+    if metrics_address != None:
+      self.metrics_endpoint = MetricsEndpoint(self.metrics, self.selector,
+        metrics_address)
+
+    self.tracer = tracer
+    self.profiler = profiler
+    self.traced = [] # turns handled this iteration, finished once flushed
+    self.journal = journal
+
+  def add_metrics(self, registry):
+    self.connections_accepted = registry.counter('tiles_connections_total',
+      'Client connections accepted.')
+    registry.gauge('tiles_connections', 'Clients connected.',
+      lambda: len(self.connections))
+    registry.gauge('tiles_lobby_players', 'Clients waiting for a game.',
+      lambda: len(self.lobby))
+    self.games_started = registry.counter('tiles_games_started_total',
+      'Games started.')
+    registry.gauge('tiles_games', 'Games running.', lambda: len(self.rooms))
+    self.messages_received = registry.counter('tiles_messages_received_total',
+      'Messages received from clients.', 'type', message_type_name)
+    self.messages_sent = registry.counter('tiles_messages_sent_total',
+      'Messages queued to send to clients.', 'type', message_type_name)
+    self.bytes_received = registry.counter('tiles_bytes_received_total',
+      'Bytes received from clients.')
+    self.bytes_sent = registry.counter('tiles_bytes_sent_total',
+      'Bytes sent to clients.')
+    self.decode_failures = registry.counter('tiles_decode_failures_total',
+      'Connections closed for sending a message that could not be decoded.')
+    self.turn_seconds = registry.histogram('tiles_turn_seconds',
+      'Time taken to apply a message from a player in a game, including '
+      'placing the tile and moving the tokens.', TURN_SECONDS_BUCKETS)
+    self.send_queue_bytes = registry.histogram('tiles_send_queue_bytes',
+      'Bytes waiting to be sent to a client each time it is flushed.',
+      SEND_QUEUE_BUCKETS)
+
+  def allocate_idnum(self):
+    if self.free_idnums:
+      return self.free_idnums.pop()
+    if self.next_idnum >= tiles.IDNUM_LIMIT:
+      return None
+    idnum = self.next_idnum
+    self.next_idnum += 1
+    return idnum
+
+  def serve_forever(self):
+    log.info('listening on %s', self.listener.getsockname(),
+      extra={'worker': self.worker})
+    if self.metrics_endpoint != None:
+      log.info('serving metrics on %s',
+        self.metrics_endpoint.listener.getsockname(),
+        extra={'worker': self.worker})
+
+    try:
+      while True:
+        # connections that failed while flushing still need to be reaped
+        timeout = 0 if self.dead else None
+        if timeout == None and self.journal != None:
+          timeout = self.journal.timeout()
+
+        for key, mask in self.selector.select(timeout):
+          if key.data is None:
+            self.accept()
+            continue
+
+          connection = key.data
+          if not isinstance(connection, Connection):
+            connection.handle_event(mask)
+            continue
+          if connection.closed:
+            continue
+          if mask & selectors.EVENT_READ:
+            self.read(connection)
+          if mask & selectors.EVENT_WRITE and not connection.closed:
+            self.flush(connection)
+
+        self.reap()
+        self.matchmake()
+        self.flush_pending()
+        if self.journal != None:
+          self.journal.tick()
+    finally:
+      if self.journal != None:
+        self.journal.close()
+      if self.tracer != None:
+        self.tracer.close()
+      if self.profiler != None:
+        self.profiler.dump()
+
+  def accept(self):
+    """Accept every connection waiting on the listening socket."""
     while True:
-      msg, consumed = tiles.read_message_from_bytearray(buffer)
-      if not consumed:
+      try:
+        sock, address = self.listener.accept()
+      except (BlockingIOError, InterruptedError):
+        return
+
+      idnum = self.allocate_idnum()
+      if idnum == None:
+        log.warning('refusing connection from %s: no free idnums', address)
+        sock.close()
+        continue
+
+      log.info('received connection from %s', address,
+        extra={'idnum': idnum})
+
+      sock.setblocking(False)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+      connection = Connection(self, sock, address, idnum)
+      self.connections[idnum] = connection
+      self.connections_accepted.inc()
+      self.selector.register(sock, selectors.EVENT_READ, connection)
+
+      connection.send(tiles.MessageWelcome(idnum))
+      self.lobby.append(connection)
+
+  def read(self, connection):
+    try:
+      chunk = connection.sock.recv(4096)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError:
+      chunk = b''
+    tracer = self.tracer
+    if tracer != None:
+      received = turntrace.now_us()
+
+    if not chunk:
+      log.info('client %s disconnected', connection.address,
+        extra={'idnum': connection.idnum})
+      self.close(connection)
+      return
+    self.bytes_received.inc(amount=len(chunk))
+
+    try:
+      msgs = connection.decoder.feed(chunk)
+    except ProtocolError as e:
+      log.warning('client %s sent a bad message: %s', connection.address, e,
+        extra={'idnum': connection.idnum})
+      self.decode_failures.inc()
+      self.close(connection)
+      return
+    if tracer != None:
+      decoded = turntrace.now_us()
+
+    debug = log.isEnabledFor(logging.DEBUG)
+    for msg in msgs:
+      if connection.closed:
         break
 
-      buffer = buffer[consumed:]
-
-      print('received message {}'.format(msg))
-
-      # sent by the player to put a tile onto the board (in all turns except
-      # their second)
-      if isinstance(msg, tiles.MessagePlaceTile):
-        if board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum):
-          # notify client that placement was successful
-          connection.send(msg.pack())
-
-          # check for token movement
-          positionupdates, eliminated = board.do_player_movement(live_idnums)
-
-          for msg in positionupdates:
-            connection.send(msg.pack())
-          
-          if idnum in eliminated:
-            connection.send(tiles.MessagePlayerEliminated(idnum).pack())
-            return
-
-          # pickup a new tile
-          tileid = tiles.get_random_tileid()
-          connection.send(tiles.MessageAddTileToHand(tileid).pack())
-
-          # start next turn
-          connection.send(tiles.MessagePlayerTurn(idnum).pack())
-
-      # sent by the player in the second turn, to choose their token's
-      # starting path
-      elif isinstance(msg, tiles.MessageMoveToken):
-        if not board.have_player_position(msg.idnum):
-          if board.set_player_start_position(msg.idnum, msg.x, msg.y, msg.position):
-            # check for token movement
-            positionupdates, eliminated = board.do_player_movement(live_idnums)
-
-            for msg in positionupdates:
-              connection.send(msg.pack())
-            
-            if idnum in eliminated:
-              connection.send(tiles.MessagePlayerEliminated(idnum).pack())
-              return
-            
-            # start next turn
-            connection.send(tiles.MessagePlayerTurn(idnum).pack())
-
-
-# create a TCP/IP socket
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-# listen on all network interfaces
-server_address = ('', 30020)
-sock.bind(server_address)
-
-print('listening on {}'.format(sock.getsockname()))
-
-sock.listen(5)
-
-while True:
-  # handle each new connection independently
-  connection, client_address = sock.accept()
-  print('received connection from {}'.format(client_address))
-  client_handler(connection, client_address)
+      if debug:
+        log.debug('received message %s', msg, extra={'idnum': connection.idnum})
+      self.messages_received.inc(message_type(msg))
+
+      room = connection.room
+      if room != None:
+        if tracer != None:
+          # one row of the trace per game, named after its first player
+          turn = tracer.begin(message_type_name(message_type(msg)),
+            room.players[0].idnum, received)
+          turn.mark('decode', decoded)
+          room.trace = turn
+
+        start = time.perf_counter()
+        try:
+          if self.profiler == None:
+            room.handle_message(connection, msg)
+          else:
+            with self.profiler:
+              room.handle_message(connection, msg)
+        except Exception:
+          # a bug in one game must not take down every other game
+          log.exception('error handling message %s from client %s', msg,
+            connection.address, extra={'idnum': connection.idnum})
+          room.trace = None
+          self.close(connection)
+          break
+        self.turn_seconds.observe(time.perf_counter() - start)
+
+        if tracer != None:
+          turn.mark('queue')
+          room.trace = None
+          self.traced.append(turn)
+
+        if room.finished:
+          self.finish_room(room)
+
+  def flush_pending(self):
+    pending = self.pending
+    self.pending = []
+    for connection in pending:
+      if not connection.closed:
+        self.flush(connection)
+
+    if self.traced:
+      flushed = turntrace.now_us()
+      for turn in self.traced:
+        turn.mark('flush', flushed)
+        self.tracer.finish(turn)
+      self.traced.clear()
+
+  def flush(self, connection):
+    """Write as much of connection's outgoing buffer as the socket accepts,
+    and only ask the selector for write readiness while some is left over.
+    """
+    if connection.outbuf:
+      self.send_queue_bytes.observe(len(connection.outbuf))
+      try:
+        with connection.outbuf.view() as view:
+          sent = connection.sock.send(view)
+      except (BlockingIOError, InterruptedError):
+        sent = 0
+      except OSError:
+        self.close_later(connection)
+        return
+      connection.outbuf.consume(sent)
+      self.bytes_sent.inc(amount=sent)
+
+    events = selectors.EVENT_READ
+    if connection.outbuf:
+      events |= selectors.EVENT_WRITE
+    key = self.selector.get_key(connection.sock)
+    if key.events != events:
+      self.selector.modify(connection.sock, events, connection)
+
+  def close_later(self, connection):
+    """Close connection once the current event has been handled, so that
+    rooms are never modified while they are broadcasting.
+    """
+    if not connection.closed:
+      connection.closed = True
+      self.dead.append(connection)
+
+  def reap(self):
+    while self.dead:
+      self.close(self.dead.pop())
+
+  def close(self, connection):
+    connection.closed = True
+
+    if self.connections.pop(connection.idnum, None) is None:
+      return
+
+    self.selector.unregister(connection.sock)
+    connection.sock.close()
+    self.free_idnums.append(connection.idnum)
+
+    if connection in self.lobby:
+      self.lobby.remove(connection)
+
+    room = connection.room
+    if room != None:
+      connection.room = None
+      room.remove_player(connection)
+      if room.finished:
+        self.finish_room(room)
+
+  def finish_room(self, room):
+    """Send the players of a finished game back to the lobby."""
+    if room not in self.rooms:
+      return
+
+    self.rooms.remove(room)
+    self.report_games()
+    if room.recorder != None:
+      room.recorder.end(room.live_idnums)
+    log.info('game finished, %d games running', len(self.rooms))
+
+    for player in room.connected:
+      player.room = None
+      if not player.closed:
+        self.lobby.append(player)
+
+  def matchmake(self):
+    """Start as many games as the players waiting in the lobby allow."""
+    while len(self.lobby) >= 2:
+      count = min(len(self.lobby), self.rules.player_limit)
+      players = [self.lobby.popleft() for _ in range(count)]
+
+      # the seed is journalled, so the tiles dealt can be drawn again
+      seed = random.getrandbits(64)
+      room = GameRoom(players, rng=random.Random(seed), rules=self.rules)
+      if self.journal != None:
+        room.recorder = self.journal.start_game(seed,
+          [player.idnum for player in players])
+      for player in players:
+        player.room = room
+      self.rooms.add(room)
+      self.games_started.inc()
+      self.report_games()
+
+      log.info('starting game with %d players, %d games running', count,
+        len(self.rooms), extra={'idnums': [player.idnum for player in players]})
+
+      if self.profiler == None:
+        room.start()
+      else:
+        with self.profiler:
+          room.start()
+      if room.finished:
+        self.finish_room(room)
+
+  def report_games(self):
+    if self.gamecounts != None:
+      self.gamecounts[self.worker] = len(self.rooms)
+
+
+def make_listener(address, backlog=128, reuseport=False):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuseport:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  sock.bind(address)
+  sock.listen(backlog)
+  return sock
+
+
+def metrics_address_for(metrics_port, worker=0):
+  """The local address a worker serves its metrics on, or None."""
+  if metrics_port == None:
+    return None
+  return ('127.0.0.1', metrics_port + worker)
+
+
+def make_instruments(trace_path, profile_path):
+  """The turntrace.Tracer and turntrace.RoomProfiler writing to the given
+  paths, or None for each path not given.
+  """
+  tracer = turntrace.Tracer(trace_path) if trace_path != None else None
+  profiler = None
+  if profile_path != None:
+    profiler = turntrace.RoomProfiler(profile_path)
+  return tracer, profiler
+
+
+def make_journal(journal_path, rules, fsync):
+  """The gamejournal.GameJournal at journal_path, or None if not given."""
+  if journal_path == None:
+    return None
+  return gamejournal.GameJournal(journal_path, rules, fsync)
+
+
+def run_worker(address, worker, gamecounts, listener, rules, metrics_port,
+    trace_path, profile_path, journal_path, fsync):
+  """Entry point of a worker process. With SO_REUSEPORT each worker binds its
+  own listening socket; otherwise they all accept from the listener inherited
+  from the parent.
+  """
+  # only stop when the parent terminates us, so a ^C (sent to the parent and
+  # the workers alike) doesn't interrupt writing the trace and profile
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+  try:
+    tracer, profiler = make_instruments(trace_path, profile_path)
+    server = Server(address, listener=listener, reuseport=listener == None,
+      gamecounts=gamecounts, worker=worker, rules=rules,
+      metrics_address=metrics_address_for(metrics_port, worker),
+      tracer=tracer, profiler=profiler,
+      journal=make_journal(journal_path, rules, fsync))
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def run_workers(address, count, rules=STANDARD_RULES, interval=10.0,
+    metrics_port=None, trace_path=None, profile_path=None, journal_path=None,
+    fsync='interval'):
+  """Fork count worker processes to serve address, then report how many games
+  each one is running every interval seconds. Worker i serves its metrics on
+  metrics_port + i, if metrics_port is given, and writes its trace, profile
+  and journal to the given paths with .i added.
+  """
+  ctx = multiprocessing.get_context('fork')
+  gamecounts = ctx.Array('i', count, lock=False)
+
+  # without SO_REUSEPORT, bind once here and let the workers share the socket
+  listener = None
+  if not hasattr(socket, 'SO_REUSEPORT'):
+    listener = make_listener(address)
+
+  workers = []
+  for worker in range(count):
+    process = ctx.Process(target=run_worker, name='worker-{}'.format(worker),
+      args=(address, worker, gamecounts, listener, rules, metrics_port,
+        turntrace.worker_path(trace_path, worker, count),
+        turntrace.worker_path(profile_path, worker, count),
+        turntrace.worker_path(journal_path, worker, count), fsync),
+      daemon=True)
+    process.start()
+    workers.append(process)
+
+  log.info('started %d workers on port %d', count, address[1])
+
+  try:
+    while any(process.is_alive() for process in workers):
+      time.sleep(interval)
+      log.info('games per worker: %s (total %d)', list(gamecounts),
+        sum(gamecounts))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for process in workers:
+      process.terminate()
+    for process in workers:
+      process.join()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Tiles game server.')
+  parser.add_argument('port', nargs='?', type=int, default=30020)
+  parser.add_argument('--workers', type=int, default=1,
+    help='number of worker processes (default: 1, no forking)')
+  parser.add_argument('--metrics-port', type=int, default=None,
+    help='serve metrics over HTTP on localhost at this port (plus the worker '
+    'number, with --workers)')
+  parser.add_argument('--trace', metavar='FILE', default=None,
+    help='write the phases of every turn to FILE in the Chrome trace format')
+  parser.add_argument('--profile', metavar='FILE', default=None,
+    help='profile the game rooms with cProfile, writing the stats to FILE')
+  parser.add_argument('--journal', metavar='FILE', default=None,
+    help='record every game to FILE (see gamejournal.py)')
+  parser.add_argument('--fsync', choices=gamejournal.FSYNC_POLICIES,
+    default='interval', help='when the journal is synced to disk: after '
+    'every event loop iteration, once a second, or when the OS chooses '
+    '(default: %(default)s)')
+  add_rules_arguments(parser)
+  jsonlog.add_logging_arguments(parser)
+  args = parser.parse_args(argv[1:])
+
+  jsonlog.configure_from_arguments(args)
+  rules = rules_from_arguments(args)
+  if not rules.is_standard():
+    log.info('using non-standard %s', rules)
+
+  # listen on all network interfaces
+  address = ('', args.port)
+
+  # stop on SIGTERM (e.g. from kill) as on ^C, so that the trace, profile and
+  # journal are written out, and any workers are stopped too
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+  if args.workers > 1:
+    run_workers(address, args.workers, rules, metrics_port=args.metrics_port,
+      trace_path=args.trace, profile_path=args.profile,
+      journal_path=args.journal, fsync=args.fsync)
+  else:
+    tracer, profiler = make_instruments(args.trace, args.profile)
+    server = Server(address, rules=rules,
+      metrics_address=metrics_address_for(args.metrics_port), tracer=tracer,
+      profiler=profiler, journal=make_journal(args.journal, rules, args.fsync))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,206 @@
+# CITS3002 2021 Assignment
+#
+# This module plays complete games in-process, with no sockets or windows. The
+# players are driven by policies, and each game runs through game.GameRoom, so
+# the simulated games follow exactly the same rules as the server's.
+#
+# A policy is a function policy(room, idnum, rng) that is called at the start
+# of each of player idnum's turns. It returns the tiles.MessagePlaceTile or
+# tiles.MessageMoveToken that the player sends, or None if the player has no
+# legal move (they are then removed from the game).
+#
+# usage: python sim.py [--games N] [--policy NAME ...] [options]
+# which plays games and reports the games, turns and token movement steps per
+# second. This is the baseline benchmark for changes to the game engine.
+
+import argparse
+import random
+import sys
+import time
+from collections import namedtuple
+
+import tiles
+from engine import STANDARD_RULES, add_rules_arguments, rules_from_arguments
+from game import GameRoom
+
+
+GameResult = namedtuple('GameResult', 'winners turns steps')
+
+
+class SimPlayer:
+  """A player in a simulated game. Messages sent to them are discarded, as
+  their policy reads the state of the room directly.
+  """
+
+  def __init__(self, idnum, policy):
+    self.idnum = idnum
+    self.name = 'sim{}'.format(idnum)
+    self.policy = policy
+
+  def send(self, msg):
+    pass
+
+
+def first_tile_squares(board):
+  """The empty squares on the edge of the board, where a first tile may be
+  placed.
+  """
+  return [(x, y) for y in range(board.height) for x in range(board.width)
+    if (x == 0 or y == 0 or x == board.width - 1 or y == board.height - 1)
+    and board.get_tile(x, y)[0] == None]
+
+
+def placed_square(board, idnum):
+  """The square of the first tile placed by idnum."""
+  idx = board.tileplaceids.index(idnum)
+  return idx % board.width, idx // board.width
+
+
+def random_policy(room, idnum, rng):
+  """Play any legal move, chosen uniformly at random."""
+  board = room.board
+  hand = room.hands[idnum]
+
+  if idnum not in room.placed:
+    squares = first_tile_squares(board)
+    if not squares:
+      return None
+    x, y = rng.choice(squares)
+  elif not board.have_player_position(idnum):
+    x, y = placed_square(board, idnum)
+    return tiles.MessageMoveToken(idnum, x, y,
+      rng.choice(board.start_positions(x, y)))
+  else:
+    x, y, _ = board.get_player_position(idnum)
+
+  return tiles.MessagePlaceTile(idnum, rng.choice(hand), rng.randrange(4),
+    x, y)
+
+
+def first_policy(room, idnum, rng):
+  """Always play the first legal move: the first tile in hand, unrotated, and
+  the first square or start position available.
+  """
+  board = room.board
+  hand = room.hands[idnum]
+
+  if idnum not in room.placed:
+    squares = first_tile_squares(board)
+    if not squares:
+      return None
+    x, y = squares[0]
+  elif not board.have_player_position(idnum):
+    x, y = placed_square(board, idnum)
+    return tiles.MessageMoveToken(idnum, x, y, board.start_positions(x, y)[0])
+  else:
+    x, y, _ = board.get_player_position(idnum)
+
+  return tiles.MessagePlaceTile(idnum, hand[0], 0, x, y)
+
+
+def safe_policy(room, idnum, rng):
+  """Play a random move that does not eliminate the player, preferring those
+  that eliminate the most other players.
+  """
+  moves = room.board.legal_moves(idnum, room.hands[idnum], room.live_idnums)
+  if not moves:
+    return None
+
+  safe = [move for move in moves if not move.outcome.eliminated]
+  if safe:
+    most = max(len(move.outcome.eliminates) for move in safe)
+    moves = [move for move in safe if len(move.outcome.eliminates) == most]
+
+  return rng.choice(moves).message(idnum)
+
+
+POLICIES = {
+  'random': random_policy,
+  'first': first_policy,
+  'safe': safe_policy,
+}
+
+
+def play_game(policies, seed=None, rules=STANDARD_RULES):
+  """Play one game to the end, with a player for each of the given policies,
+  in turn order. The tiles drawn and the policies' choices are all made with
+  a random.Random seeded with seed, so a game can be played again exactly.
+
+  Returns a GameResult: the idnums still live at the end, the number of turns
+  played, and the number of squares moved across by the tokens.
+  """
+  if len(policies) < 2 or len(policies) > rules.player_limit:
+    raise ValueError('a game needs 2..{} players'.format(rules.player_limit))
+
+  rng = random.Random(seed)
+  players = [SimPlayer(idnum, policy) for idnum, policy in enumerate(policies)]
+  room = GameRoom(players, rng=rng, rules=rules)
+  room.start()
+
+  turns = 0
+  while not room.finished:
+    player = room.current
+    msg = player.policy(room, player.idnum, rng)
+    if msg == None:
+      room.remove_player(player)
+    else:
+      room.handle_message(player, msg)
+
+      # the turn only stays with the player if their move was rejected
+      if not room.finished and room.current is player:
+        raise ValueError('policy {} made an illegal move: {}'.format(
+          player.policy.__name__, vars(msg)))
+    turns += 1
+
+  return GameResult(list(room.live_idnums), turns, room.board.steps)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Headless self-play games.')
+  parser.add_argument('--games', type=int, default=2000)
+  parser.add_argument('--policy', action='append', choices=sorted(POLICIES),
+    help='policy of the next player; repeat for each player '
+    '(default: random for every player)')
+  parser.add_argument('--players', type=int, default=None,
+    help='players in each game, when no policies are given '
+    '(default: the player limit)')
+  parser.add_argument('--seed', type=int, default=0,
+    help='seed of the first game; game i uses seed + i')
+  add_rules_arguments(parser)
+  args = parser.parse_args(argv[1:])
+
+  rules = rules_from_arguments(args)
+  if args.policy:
+    policies = [POLICIES[name] for name in args.policy]
+  else:
+    count = args.players if args.players != None else rules.player_limit
+    policies = [random_policy] * count
+
+  turns = 0
+  steps = 0
+  wins = [0] * len(policies)
+  draws = 0
+
+  start = time.perf_counter()
+  for i in range(args.games):
+    result = play_game(policies, args.seed + i, rules)
+    turns += result.turns
+    steps += result.steps
+    for idnum in result.winners:
+      wins[idnum] += 1
+    if not result.winners:
+      draws += 1
+  elapsed = time.perf_counter() - start
+
+  print('{} games of {} players in {:.2f}s'.format(args.games, len(policies),
+    elapsed))
+  print('{:>12.0f} games/s'.format(args.games / elapsed))
+  print('{:>12.0f} turns/s'.format(turns / elapsed))
+  print('{:>12.0f} steps/s'.format(steps / elapsed))
+  for idnum, policy in enumerate(policies):
+    print('player {} ({}): {} wins'.format(idnum, policy.__name__, wins[idnum]))
+  print('no winner: {}'.format(draws))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
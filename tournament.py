@@ -0,0 +1,145 @@
+# CITS3002 2021 Assignment
+#
+# This module plays large numbers of seeded games between policies (see
+# sim.py), spread over a pool of worker processes. Each worker plays a batch
+# of consecutive seeds and sends back one compact array of results, so the
+# cost of passing results between processes stays small next to the cost of
+# playing the games.
+#
+# To be fair to every policy, the seats are rotated from game to game: in the
+# game with seed s, the player in seat i uses policy (i + s) % n.
+#
+# usage: python tournament.py POLICY POLICY [POLICY ...] [--games N] [options]
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import sim
+from engine import STANDARD_RULES, add_rules_arguments, rules_from_arguments
+
+
+# each game's result in a batch is RECORD_SIZE ints: the index of the winning
+# policy (or -1 if no one won), the turns played and the token steps moved
+RECORD_SIZE = 3
+
+
+def play_batch(names, seed, count, rules=STANDARD_RULES):
+  """Play the games with seeds seed..seed+count-1 between the named policies,
+  and return their results as an array of RECORD_SIZE ints per game.
+  """
+  policies = [sim.POLICIES[name] for name in names]
+  results = array('i')
+
+  for game in range(seed, seed + count):
+    shift = game % len(policies)
+    seats = policies[shift:] + policies[:shift]
+
+    result = sim.play_game(seats, game, rules)
+
+    winner = -1
+    if result.winners:
+      winner = (result.winners[0] + shift) % len(policies)
+    results.extend((winner, result.turns, result.steps))
+
+  return results
+
+
+def play_batches(names, games, workers, batchsize=500, seed=0,
+    rules=STANDARD_RULES):
+  """Play games games (with seeds seed, seed+1, ...) across workers processes,
+  and yield the results of each batch as play_batch returns them, in seed
+  order.
+
+  Only a few batches per worker are queued at once, so any number of games
+  can be played without holding all of their results in memory.
+  """
+  context = multiprocessing.get_context('fork')
+  with ProcessPoolExecutor(workers, mp_context=context) as executor:
+    queued = deque()
+    nextseed = seed
+    end = seed + games
+
+    while queued or nextseed < end:
+      while nextseed < end and len(queued) < workers * 4:
+        count = min(batchsize, end - nextseed)
+        queued.append(executor.submit(play_batch, names, nextseed, count,
+          rules))
+        nextseed += count
+
+      yield queued.popleft().result()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Play policies against each '
+    'other in many seeded games.')
+  parser.add_argument('policies', nargs='+', choices=sorted(sim.POLICIES),
+    metavar='POLICY', help='one of: {}'.format(', '.join(sorted(sim.POLICIES))))
+  parser.add_argument('--games', type=int, default=100000)
+  parser.add_argument('--workers', type=int, default=os.cpu_count(),
+    help='worker processes (default: one per cpu)')
+  parser.add_argument('--batch', type=int, default=500,
+    help='games in each batch sent to a worker (default: %(default)s)')
+  parser.add_argument('--seed', type=int, default=0,
+    help='seed of the first game; game i uses seed + i')
+  parser.add_argument('--output', metavar='FILE',
+    help='write the results of every game to FILE, in seed order, as '
+    '{} native 32 bit ints per game'.format(RECORD_SIZE))
+  add_rules_arguments(parser)
+  args = parser.parse_args(argv[1:])
+
+  rules = rules_from_arguments(args)
+  if len(args.policies) < 2 or len(args.policies) > rules.player_limit:
+    parser.error('give 2..{} policies'.format(rules.player_limit))
+  if args.games < 1:
+    parser.error('--games must be at least 1')
+  if args.batch < 1:
+    parser.error('--batch must be at least 1')
+
+  wins = [0] * len(args.policies)
+  draws = 0
+  played = 0
+  turns = 0
+  output = open(args.output, 'wb') if args.output else None
+
+  start = time.perf_counter()
+  lastreport = start
+  try:
+    for results in play_batches(args.policies, args.games, args.workers,
+        args.batch, args.seed, rules):
+      if output:
+        results.tofile(output)
+
+      for i in range(0, len(results), RECORD_SIZE):
+        winner = results[i]
+        if winner < 0:
+          draws += 1
+        else:
+          wins[winner] += 1
+        turns += results[i + 1]
+      played += len(results) // RECORD_SIZE
+
+      now = time.perf_counter()
+      if now - lastreport >= 10:
+        lastreport = now
+        print('{} games, {:.0f} games/s'.format(played, played / (now - start)))
+  finally:
+    if output:
+      output.close()
+  elapsed = time.perf_counter() - start
+
+  print('{} games with {} workers in {:.2f}s: {:.0f} games/s, {:.0f} turns/s'
+    .format(played, args.workers, elapsed, played / elapsed, turns / elapsed))
+  for index, name in enumerate(args.policies):
+    print('{:>3} {:>10} {:>10} wins {:>7.2%}'.format(index, name, wins[index],
+      wins[index] / played))
+  print('{:>14} {:>10}      {:>7.2%}'.format('no winner', draws, draws / played))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,125 @@
+# CITS3002 2021 Assignment
+#
+# This module traces how long each phase of a turn takes on the server, and
+# profiles the game room code, to find where slow turns spend their time.
+#
+# A Tracer writes spans in the Chrome trace event format, which can be opened
+# in chrome://tracing or https://ui.perfetto.dev. Each turn is one span, split
+# into a span per phase, one row per game:
+#   decode    the bytes received being decoded into messages
+#   validate  the move being checked and made (e.g. Board.set_tile)
+#   movement  the tokens moving (Board.do_player_movement_at)
+#   queue     the results being queued to send to the players
+#   flush     everything queued being written to the sockets
+# A phase that a turn doesn't reach (e.g. an illegal move) is left out.
+#
+# A RoomProfiler runs cProfile over the game rooms' code only, leaving out
+# the time spent waiting on and writing to sockets.
+#
+# Both are off unless the server is run with --trace or --profile; when off,
+# each phase costs the server one comparison with None.
+
+import cProfile
+import json
+import os
+import time
+
+
+def now_us():
+  return time.perf_counter() * 1e6
+
+
+class Turn:
+  """The times at which one turn reached each phase, in microseconds."""
+
+  __slots__ = ('name', 'lane', 'start', 'marks')
+
+  def __init__(self, name, lane, start):
+    self.name = name
+    self.lane = lane
+    self.start = start
+    self.marks = []
+
+  def mark(self, phase, at=None):
+    """Record that the phase named phase finished at time at (default now,
+    from now_us()).
+    """
+    self.marks.append((phase, at if at != None else now_us()))
+
+
+class Tracer:
+  """Writes the phases of turns to a file, as a JSON array of Chrome trace
+  events. The array is closed by close(), but trace viewers also read files
+  left unfinished, e.g. by a killed server.
+  """
+
+  def __init__(self, path):
+    self.file = open(path, 'w')
+    self.file.write('[\n')
+    self.pid = os.getpid()
+    self.turns = 0
+
+  def begin(self, name, lane, start):
+    """Start tracing a turn that began (when its bytes were received) at
+    start, from now_us(). lane groups turns into rows, e.g. by game.
+    """
+    return Turn(name, lane, start)
+
+  def finish(self, turn):
+    """Write turn, and a span for each of its phases."""
+    end = turn.marks[-1][1] if turn.marks else now_us()
+    events = [self.event(turn.name, turn, turn.start, end, 'turn')]
+
+    last = turn.start
+    for phase, at in turn.marks:
+      events.append(self.event(phase, turn, last, at, 'phase'))
+      last = at
+
+    self.file.write(''.join(json.dumps(event, separators=(',', ':')) + ',\n'
+      for event in events))
+    self.turns += 1
+
+  def event(self, name, turn, start, end, category):
+    return {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid,
+      'tid': turn.lane, 'ts': round(start, 3), 'dur': round(end - start, 3)}
+
+  def close(self):
+    # a final event with no trailing comma makes the array valid JSON
+    self.file.write(json.dumps({'name': 'turns traced', 'ph': 'i', 's': 'p',
+      'pid': self.pid, 'ts': round(now_us(), 3), 'args': {'turns': self.turns}}))
+    self.file.write('\n]\n')
+    self.file.close()
+
+
+class RoomProfiler:
+  """cProfile, enabled only while game room code is running:
+
+    with profiler:
+      room.handle_message(player, msg)
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.profile = cProfile.Profile()
+
+  def __enter__(self):
+    self.profile.enable()
+    return self
+
+  def __exit__(self, *exc):
+    self.profile.disable()
+
+  def dump(self):
+    """Write the statistics so far to path, to read with pstats, e.g.
+    python -m pstats PATH.
+    """
+    self.profile.dump_stats(self.path)
+
+
+def worker_path(path, worker, workers):
+  """The file a worker writes to: path itself with a single worker, or path
+  with the worker number added.
+  """
+  if path == None or workers <= 1:
+    return path
+  return '{}.{}'.format(path, worker)
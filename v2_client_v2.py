@@ -11,13 +11,19 @@
 
 from tkinter import *
 from tkinter.ttk import *
+import jsonlog
 import tiles
+import logging
 import random
 import socket
 import sys
 import threading
 import select
 
+# every message from the server is logged at debug level, which is off unless
+# TILES_LOG_LEVEL=debug is set (see jsonlog.py)
+log = logging.getLogger('client')
+
 class Application(Frame):
   TILE_PX = 80 # pixels
   BORDER_PX = 50 # pixels
@@ -129,7 +135,7 @@ class Application(Frame):
     if self.lasttilelocation != None and self.location == None:
       return
     
-    print('play tile at {}, {}'.format(x, y))
+    log.info('play tile at %d, %d', x, y)
 
     if self.sock:
       with self.infolock:
@@ -153,7 +159,7 @@ class Application(Frame):
     with self.boardlock:
       if self.lasttilelocation and not self.location:
         x, y = self.lasttilelocation
-        print('start at {},{}:{}'.format(x, y, position))
+        log.info('start at %d,%d:%d', x, y, position)
         self.sock.send(tiles.MessageMoveToken(self.idnum, x, y, position).pack())
   
   def clear_board(self):
@@ -208,6 +214,8 @@ class Application(Frame):
 
 Tcl().eval('set tcl_platform(threaded)')
 
+jsonlog.configure()
+
 exited = False
 
 root = Tk()
@@ -223,7 +231,7 @@ app = Application(parent=root)
 app.parent.title("Client")
 
 def reset_game_state():
-  print('resetting game state')
+  log.debug('resetting game state')
 
   with app.handlock:
     for i in range(len(app.hand)):
@@ -268,7 +276,7 @@ def set_player_eliminated(idnum):
         playername = app.playernames[idnum]
         app.playerlist.remove(playername)
       else:
-        print('Unknown player eliminated: {}'.format(idnum))
+        log.warning('Unknown player eliminated: %s', idnum)
     app.playerlistvar.set(app.playerlist)
 
     if not idnum in app.eliminatedlist:
@@ -278,7 +286,7 @@ def set_player_eliminated(idnum):
   app.event_generate("<<RedrawTurn>>")
 
 def tile_placed(msg):
-  print('tile {} at {}, {} : {} from {}'.format(msg.tileid, msg.x, msg.y, msg.rotation, msg.idnum))
+  log.debug('tile %d at %d, %d : %d from %d', msg.tileid, msg.x, msg.y, msg.rotation, msg.idnum)
 
   with app.boardlock:
     # we don't use board.set_tile() here, because we trust the server, and we're
@@ -321,7 +329,7 @@ def tile_placed(msg):
 def token_moved(msg):
   with app.boardlock:
     if msg.idnum == app.idnum:
-      print('Setting own location')
+      log.debug('Setting own location')
       app.location = (msg.x, msg.y, msg.position)
     app.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
   
@@ -356,33 +364,33 @@ def communication_thread(sock):
             buffer = buffer[consumed:]
 
             if isinstance(msg, tiles.MessageWelcome):
-              print('Welcome!')
+              log.info('Welcome!')
               with app.infolock:
                 app.idnum = msg.idnum
                 app.playernames[app.idnum] = 'Me!'
             
             elif isinstance(msg, tiles.MessagePlayerJoined):
-              print('Player {} joined, id {}'.format(msg.name, msg.idnum))
+              log.debug('Player %s joined, id %d', msg.name, msg.idnum)
               with app.infolock:
                 app.playernames[msg.idnum] = msg.name
             
             elif isinstance(msg, tiles.MessagePlayerLeft):
-              print('Player id {} left'.format(msg.idnum))
+              log.debug('Player id %d left', msg.idnum)
               with app.infolock:
                 if msg.idnum in app.playernames:
                   del app.playernames[msg.idnum]
                 else:
-                  print("...I didn't know they were a player!")
+                  log.warning("...I didn't know they were a player!")
             
             elif isinstance(msg, tiles.MessageCountdown):
-              print('Countdown starting...')
+              log.debug('Countdown starting...')
             
             elif isinstance(msg, tiles.MessageGameStart):
-              print('Game starting...')
+              log.info('Game starting...')
               reset_game_state()
             
             elif isinstance(msg, tiles.MessageAddTileToHand):
-              print('Add tile {} to hand'.format(msg.tileid))
+              log.debug('Add tile %d to hand', msg.tileid)
               tileid = msg.tileid
               
               if tileid < 0 or tileid >= len(tiles.ALL_TILES):
@@ -391,7 +399,7 @@ def communication_thread(sock):
               add_tile_to_hand(tileid)
             
             elif isinstance(msg, tiles.MessagePlayerTurn):
-              print('Player turn: {}'.format(msg))
+              log.debug('Player turn: %s', msg)
 
               with app.infolock:
                 if msg.idnum not in app.playernames:
@@ -400,7 +408,7 @@ def communication_thread(sock):
               set_player_turn(msg.idnum)
             
             elif isinstance(msg, tiles.MessagePlaceTile):
-              print('Place tile: {}'.format(msg))
+              log.debug('Place tile: %s', msg)
 
               with app.infolock:
                 if msg.idnum not in app.playernames:
@@ -409,7 +417,7 @@ def communication_thread(sock):
               tile_placed(msg)
             
             elif isinstance(msg, tiles.MessageMoveToken):
-              print('Move token: {}'.format(msg))
+              log.debug('Move token: %s', msg)
 
               with app.infolock:
                 if msg.idnum not in app.playernames:
@@ -418,7 +426,7 @@ def communication_thread(sock):
               token_moved(msg)
             
             elif isinstance(msg, tiles.MessagePlayerEliminated):
-              print('Player eliminated: {}'.format(msg))
+              log.debug('Player eliminated: %s', msg)
 
               with app.infolock:
                 if msg.idnum not in app.playernames:
@@ -427,16 +435,16 @@ def communication_thread(sock):
               set_player_eliminated(msg.idnum)
             
             else:
-              print('Unknown message: {}'.format(msg))
+              log.warning('Unknown message: %s', msg)
           else:
             break
       else:
         break
     except Exception as e:
-      print('Error: {}'.format(e))
+      log.error('Error: %s', e)
       break
   
-  print('Server closed connection')
+  log.info('Server closed connection')
 
   if not exited:
     app.event_generate('<<CloseConnection>>')
@@ -448,7 +456,7 @@ server_host = 'localhost'
 if len(sys.argv) > 2:
   server_host = sys.argv[1]
 
-print('Using server hostname {}'.format(server_host))
+log.info('Using server hostname %s', server_host)
 
 server_address = (server_host, 30020)
 sock.connect(server_address)
@@ -462,7 +470,7 @@ try:
   app.sock = sock
   app.mainloop()
 finally:
-  print('closing sock')
+  log.info('closing sock')
   sock.shutdown(socket.SHUT_WR)
   sock.close()
 